@@ -0,0 +1,443 @@
+"""本地性能测试：用本机的上游代理桩测量握手延迟和吞吐量
+
+用法：
+    python benchmark.py                     # 运行全部socket选项组合
+    python benchmark.py --profiles baseline,nodelay --iterations 500
+    python benchmark.py --idle 10000 --stack-size 256 --max-rss-per-tunnel 64
+"""
+import argparse
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from config import Config
+from socks5_server import Socks5Server
+
+# 上游代理桩根据目标端口决定行为
+ECHO_PORT = 1
+DOWNLOAD_PORT = 2
+
+# 待测试的socket选项组合，写入临时配置的 [SocketOptions]
+PROFILES = {
+    'baseline': {
+        'client_nodelay': 'False', 'client_keepalive': 'False',
+        'upstream_nodelay': 'False', 'upstream_keepalive': 'False'
+    },
+    'nodelay': {
+        'client_nodelay': 'True', 'client_keepalive': 'False',
+        'upstream_nodelay': 'True', 'upstream_keepalive': 'False'
+    },
+    'keepalive': {
+        'client_nodelay': 'False', 'client_keepalive': 'True',
+        'upstream_nodelay': 'False', 'upstream_keepalive': 'True'
+    },
+    'buffers': {
+        'client_nodelay': 'False', 'client_keepalive': 'False',
+        'upstream_nodelay': 'False', 'upstream_keepalive': 'False',
+        'listener_rcvbuf': '1048576', 'listener_sndbuf': '1048576',
+        'upstream_rcvbuf': '1048576', 'upstream_sndbuf': '1048576'
+    },
+    'fastopen': {
+        'client_nodelay': 'False', 'client_keepalive': 'False',
+        'upstream_nodelay': 'False', 'upstream_keepalive': 'False',
+        'upstream_fastopen': 'True'
+    },
+    'default': {}
+}
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('连接已关闭')
+        data += chunk
+    return data
+
+
+class DelayedReader:
+    """每次真正从socket读取一批数据前等待 delay 秒，模拟上游的网络延迟"""
+
+    def __init__(self, sock, delay):
+        self.sock = sock
+        self.delay = delay
+        self.buffer = b''
+
+    def read_exact(self, size):
+        while len(self.buffer) < size:
+            if self.delay:
+                time.sleep(self.delay)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('连接已关闭')
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class StubUpstream:
+    """最小的SOCKS5上游代理，CONNECT后按目标端口回显或发送固定数据
+
+    设置了账号时要求用户名密码认证；delay 模拟每一轮数据到达上游的延迟。
+    """
+
+    def __init__(self, download_bytes, username='', password='', delay=0):
+        self.download_bytes = download_bytes
+        self.username = username.encode()
+        self.password = password.encode()
+        self.delay = delay
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'TCP_FASTOPEN'):
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, 256)
+            except OSError:
+                pass
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        try:
+            reader = DelayedReader(conn, self.delay)
+            _, nmethods = reader.read_exact(2)
+            methods = reader.read_exact(nmethods)
+            if self.username:
+                if 2 not in methods:
+                    conn.sendall(b'\x05\xff')
+                    return
+                conn.sendall(b'\x05\x02')
+                _, username_len = reader.read_exact(2)
+                username = reader.read_exact(username_len)
+                password = reader.read_exact(reader.read_exact(1)[0])
+                if (username, password) != (self.username, self.password):
+                    conn.sendall(b'\x01\x01')
+                    return
+                conn.sendall(b'\x01\x00')
+            else:
+                conn.sendall(b'\x05\x00')
+            _, _, _, atyp = reader.read_exact(4)
+            if atyp == 1:
+                reader.read_exact(4)
+            elif atyp == 3:
+                reader.read_exact(reader.read_exact(1)[0])
+            else:
+                reader.read_exact(16)
+            port = struct.unpack('!H', reader.read_exact(2))[0]
+            conn.sendall(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', port))
+
+            if port == DOWNLOAD_PORT:
+                chunk = b'x' * 65536
+                remaining = self.download_bytes
+                while remaining > 0:
+                    conn.sendall(chunk[:remaining])
+                    remaining -= len(chunk)
+            else:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+
+def connect_request_size(buffer):
+    """SOCKS5 CONNECT请求的总长度，数据不足以判断时返回None"""
+    if len(buffer) < 5:
+        return None
+    atyp = buffer[3]
+    if atyp == 1:
+        return 10
+    if atyp == 3:
+        return 7 + buffer[4]
+    return 22
+
+
+class IdleStubUpstream:
+    """单线程的SOCKS5上游代理桩，握手完成后保持连接空闲，用于大量并发隧道测试"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4096)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        reply = b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', 0)
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        conn, _ = self.sock.accept()
+                    except BlockingIOError:
+                        continue
+                    conn.setblocking(False)
+                    # [已收到的数据, 阶段]：0 等待问候，1 等待CONNECT，2 空闲
+                    self.selector.register(conn, selectors.EVENT_READ, [bytearray(), 0])
+                    continue
+
+                conn, state = key.fileobj, key.data
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    data = b''
+                if not data:
+                    self.selector.unregister(conn)
+                    conn.close()
+                    continue
+                if state[1] == 2:
+                    continue
+
+                buffer = state[0]
+                buffer += data
+                if state[1] == 0 and len(buffer) >= 2 and len(buffer) >= 2 + buffer[1]:
+                    del buffer[:2 + buffer[1]]
+                    conn.send(b'\x05\x00')
+                    state[1] = 1
+                if state[1] == 1:
+                    size = connect_request_size(buffer)
+                    if size and len(buffer) >= size:
+                        del buffer[:size]
+                        conn.send(reply)
+                        state[1] = 2
+
+
+class StaticIPManager:
+    """始终返回本地上游代理桩的IP管理器"""
+
+    def __init__(self, port, username='', password=''):
+        self.proxy_info = {
+            'ip': '127.0.0.1', 'port': port, 'username': username, 'password': password,
+            'extract_time': time.time()
+        }
+
+    def get_valid_ip(self, force_refresh=False):
+        return self.proxy_info
+
+    def get_fallback_ip(self, failed_ip):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(upstream_port, socket_options, extra_settings=None, upstream_auth=('', '')):
+    """用临时配置启动 Socks5Server，返回 (server, port)"""
+    port = free_port()
+    fd, path = tempfile.mkstemp(suffix='.ini')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(f"[Settings]\nport = {port}\nmode = interval\ninterval = 3600\nlog_level = 0\n")
+        for key, value in (extra_settings or {}).items():
+            f.write(f"{key} = {value}\n")
+        f.write("[SocketOptions]\n")
+        for key, value in socket_options.items():
+            f.write(f"{key} = {value}\n")
+    config = Config(path)
+    os.remove(path)
+
+    server = Socks5Server(config, StaticIPManager(upstream_port, *upstream_auth))
+    threading.Thread(target=server.start, daemon=True).start()
+    deadline = time.time() + 5
+    while not server.running and time.time() < deadline:
+        time.sleep(0.01)
+    return server, port
+
+
+def open_tunnel(port, target_port):
+    """作为客户端完成SOCKS5握手，返回已建立隧道的socket"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'\x05\x01\x00')
+    recv_exact(sock, 2)
+    host = b'bench.local'
+    sock.sendall(b'\x05\x01\x00\x03' + bytes([len(host)]) + host + struct.pack('!H', target_port))
+    recv_exact(sock, 10)
+    return sock
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_handshake(port, iterations):
+    """从建立TCP连接到隧道内首个回显往返完成的耗时（毫秒）"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        sock = open_tunnel(port, ECHO_PORT)
+        sock.sendall(b'p')
+        recv_exact(sock, 1)
+        samples.append((time.perf_counter() - start) * 1000)
+        sock.close()
+    return samples
+
+
+def bench_throughput(port):
+    """单个隧道下载上游桩发送的全部数据的吞吐量（MB/s）"""
+    sock = open_tunnel(port, DOWNLOAD_PORT)
+    received = 0
+    start = time.perf_counter()
+    while True:
+        data = sock.recv(262144)
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return received / elapsed / 1048576
+
+
+def rss_kb():
+    """当前进程的常驻内存（KB）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+
+def serve_idle(upstream_port, stack_size):
+    """子进程：只运行 Socks5Server，按父进程要求报告自身RSS"""
+    raise_fd_limit()
+    server, port = start_server(upstream_port, {}, {'thread_stack_size': stack_size})
+    print(port, flush=True)
+    for line in sys.stdin:
+        if line.strip() == 'rss':
+            print(f"{rss_kb()} {server.active_clients}", flush=True)
+    server.stop()
+
+
+def bench_idle(count, stack_size, max_rss_per_tunnel):
+    """打开 count 个空闲隧道，测量服务器进程每个隧道占用的内存"""
+    limit = raise_fd_limit()
+    if limit and limit < count * 2 + 100:
+        print(f"文件描述符上限 {limit} 不足以打开 {count} 个隧道", file=sys.stderr)
+        return 1
+
+    upstream = IdleStubUpstream()
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', str(upstream.port),
+         '--stack-size', str(stack_size)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+
+    def query():
+        child.stdin.write('rss\n')
+        child.stdin.flush()
+        rss, active = child.stdout.readline().split()
+        return int(rss), int(active)
+
+    tunnels = []
+    try:
+        port = int(child.stdout.readline())
+
+        # 预热：让延迟加载的代码路径和缓冲区池先分配好
+        for _ in range(100):
+            open_tunnel(port, ECHO_PORT).close()
+        time.sleep(0.5)
+        base_rss, _ = query()
+
+        start = time.perf_counter()
+        for _ in range(count):
+            tunnels.append(open_tunnel(port, ECHO_PORT))
+        elapsed = time.perf_counter() - start
+        time.sleep(1)
+        rss, active = query()
+
+        per_tunnel = (rss - base_rss) / count
+        print(f"tunnels: {count}  active: {active}  open time: {elapsed:.1f}s")
+        print(f"rss before: {base_rss} KB  after: {rss} KB  per tunnel: {per_tunnel:.1f} KB")
+        if max_rss_per_tunnel and per_tunnel > max_rss_per_tunnel:
+            print(f"每个隧道内存 {per_tunnel:.1f} KB 超过上限 {max_rss_per_tunnel} KB", file=sys.stderr)
+            return 1
+        return 0
+    finally:
+        for sock in tunnels:
+            sock.close()
+        child.stdin.close()
+        child.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SOCKS5代理本地性能测试')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='逗号分隔的socket选项组合')
+    parser.add_argument('--iterations', type=int, default=300, help='握手延迟测试次数')
+    parser.add_argument('--megabytes', type=int, default=200, help='吞吐量测试下载的数据量（MB）')
+    parser.add_argument('--idle', type=int, nargs='?', const=10000, default=0,
+                        help='改为测试空闲隧道内存：打开指定数量的空闲隧道（默认10000）')
+    parser.add_argument('--stack-size', type=int, default=0, help='连接处理线程栈大小（KB），0为系统默认')
+    parser.add_argument('--max-rss-per-tunnel', type=float, default=0,
+                        help='每个隧道内存上限（KB），超出时返回非零退出码')
+    parser.add_argument('--upstream-delay', type=float, default=0,
+                        help='上游代理桩每轮读取前的延迟（毫秒），模拟远端代理的往返时间')
+    parser.add_argument('--upstream-auth', action='store_true', help='上游代理桩要求用户名密码认证')
+    parser.add_argument('--pipelining', choices=('on', 'off'), help='覆盖 upstream_pipelining 设置')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_idle(args.serve, args.stack_size)
+        return 0
+    if args.idle:
+        return bench_idle(args.idle, args.stack_size, args.max_rss_per_tunnel)
+
+    auth = ('bench', 'secret') if args.upstream_auth else ('', '')
+    upstream = StubUpstream(args.megabytes * 1048576, *auth, delay=args.upstream_delay / 1000)
+    settings = {}
+    if args.pipelining:
+        settings['upstream_pipelining'] = str(args.pipelining == 'on')
+    print(f"{'profile':<12} {'p50 ms':>8} {'p99 ms':>8} {'MB/s':>9}")
+    for name in args.profiles.split(','):
+        server, port = start_server(upstream.port, PROFILES[name], settings, auth)
+        try:
+            bench_handshake(port, 20)  # 预热
+            samples = bench_handshake(port, args.iterations)
+            throughput = bench_throughput(port)
+            print(f"{name:<12} {percentile(samples, 50):>8.3f} {percentile(samples, 99):>8.3f} {throughput:>9.1f}")
+        finally:
+            server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
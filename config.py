@@ -1,5 +1,6 @@
 import configparser
 import os
+from socket_options import BOOL_OPTIONS, ROLES
 
 class Config:
     def __init__(self, config_file='config.ini'):
@@ -19,17 +20,45 @@ class Config:
         self.mode = self.config.get('Settings', 'mode', fallback='per_request')
         self.interval = self.config.getint('Settings', 'interval', fallback=0)
         self.ip_lifetime = self.config.getint('Settings', 'ip_lifetime', fallback=180)
+        self.prerotate_lead = self.config.getint('Settings', 'prerotate_lead', fallback=5)
+        self.rotation_overlap = self.config.getint('Settings', 'rotation_overlap', fallback=10)
         self.max_retries = self.config.getint('Settings', 'max_retries', fallback=3)
+        self.drain_timeout = self.config.getint('Settings', 'drain_timeout', fallback=30)
+        self.thread_stack_size = self.config.getint('Settings', 'thread_stack_size', fallback=0)
+        self.upstream_pipelining = self.config.getboolean('Settings', 'upstream_pipelining', fallback=True)
         
         # API设置
         self.api_url = self.config.get('Settings', 'api_url', fallback='')
         self.api_key = self.config.get('Settings', 'api_key', fallback='')
         self.api_format = self.config.get('Settings', 'api_format', fallback='json')
         
+        # 多接口设置，未配置 [Providers] 时使用上面的 api_url 作为唯一接口
+        self.race_providers = self.config.getboolean('Settings', 'race_providers', fallback=False)
+        self.providers = {}
+        if self.config.has_section('Providers'):
+            for key, value in self.config.items('Providers'):
+                self.providers[key] = self.parse_provider(value)
+        if not self.providers and self.api_url:
+            self.providers['default'] = {'api_url': self.api_url, 'api_format': self.api_format}
+        
+        # 换IP策略，interval 模式下的 interval 也作为时间策略参与组合
+        section = 'RotationPolicy'
+        self.rotation_policy = {
+            'combine': self.config.get(section, 'combine', fallback='any'),
+            'max_bytes': self.config.getint(section, 'max_mb', fallback=0) * 1048576,
+            'max_tunnels': self.config.getint(section, 'max_tunnels', fallback=0),
+            'max_error_rate': self.config.getfloat(section, 'max_error_rate', fallback=0),
+            'error_window': self.config.getint(section, 'error_window', fallback=20),
+            'latency_factor': self.config.getfloat(section, 'latency_factor', fallback=0)
+        }
+        
         # 验证设置
         self.check_proxies = self.config.getboolean('Settings', 'check_proxies', fallback=True)
         self.check_url = self.config.get('Settings', 'check_url', fallback='https://www.bing.com')
         self.check_timeout = self.config.getint('Settings', 'check_timeout', fallback=10)
+        self.validation_ttl = self.config.getint('Settings', 'validation_ttl', fallback=60)
+        self.reject_ttl = self.config.getint('Settings', 'reject_ttl', fallback=600)
+        self.registry_size = self.config.getint('Settings', 'registry_size', fallback=1000)
         
         # 日志设置
         self.log_level = self.config.getint('Settings', 'log_level', fallback=1)
@@ -42,6 +71,53 @@ class Config:
         if self.config.has_section('Users'):
             for key, value in self.config.items('Users'):
                 self.users[key] = value
+        
+        # 限速设置（单位 KB/s，0 表示不限制）
+        self.user_limits = {}
+        if self.config.has_section('UserLimits'):
+            for key, value in self.config.items('UserLimits'):
+                parts = [p.strip() for p in value.split(',')]
+                up = int(parts[0] or 0) * 1024 if len(parts) > 0 else 0
+                down = int(parts[1] or 0) * 1024 if len(parts) > 1 else 0
+                max_tunnels = int(parts[2] or 0) if len(parts) > 2 else 0
+                self.user_limits[key] = (up, down, max_tunnels)
+        
+        self.target_limits = {}
+        if self.config.has_section('TargetLimits'):
+            for key, value in self.config.items('TargetLimits'):
+                parts = [p.strip() for p in value.split(',')]
+                up = int(parts[0] or 0) * 1024 if len(parts) > 0 else 0
+                down = int(parts[1] or 0) * 1024 if len(parts) > 1 else 0
+                self.target_limits[key.lower()] = (up, down)
+        
+        # socket选项，按角色前缀分组，未配置的使用 socket_options 中的默认值
+        self.socket_options = {role: {} for role in ROLES}
+        if self.config.has_section('SocketOptions'):
+            for key in self.config.options('SocketOptions'):
+                role, _, name = key.partition('_')
+                if role not in self.socket_options:
+                    continue
+                if name in BOOL_OPTIONS:
+                    value = self.config.getboolean('SocketOptions', key)
+                else:
+                    value = self.config.getint('SocketOptions', key)
+                self.socket_options[role][name] = value
+    
+    def parse_provider(self, value):
+        """解析接口配置：URL 后跟空格分隔的 key=value 选项"""
+        parts = value.split()
+        options = {'api_url': parts[0] if parts else '', 'api_format': self.api_format}
+        for part in parts[1:]:
+            key, _, val = part.partition('=')
+            if key == 'format':
+                options['api_format'] = val
+            elif key == 'weight':
+                options['weight'] = float(val)
+            elif key == 'rate_limit':
+                options['rate_limit'] = int(val)
+            elif key == 'price':
+                options['price'] = float(val)
+        return options
     
     def create_default_config(self):
         self.config['Settings'] = {
@@ -50,18 +126,39 @@ class Config:
             'mode': 'per_request',
             'interval': '0',
             'ip_lifetime': '180',
+            'prerotate_lead': '5',
+            'rotation_overlap': '10',
             'max_retries': '3',
+            'drain_timeout': '30',
+            'thread_stack_size': '0',
+            'upstream_pipelining': 'True',
             'api_url': 'https://api.cliproxy.io/white/api?region=US&num=1&time=10&format=n&type=txt',
             'api_key': '',
             'api_format': 'text',
+            'race_providers': 'False',
             'check_proxies': 'True',
             'check_url': 'https://www.bing.com',
             'check_timeout': '10',
+            'validation_ttl': '60',
+            'reject_ttl': '600',
+            'registry_size': '1000',
             'log_level': '1',
             'token': 'ysld'
         }
         
+        self.config['RotationPolicy'] = {
+            'combine': 'any',
+            'max_mb': '0',
+            'max_tunnels': '0',
+            'max_error_rate': '0',
+            'error_window': '20',
+            'latency_factor': '0'
+        }
+        self.config['Providers'] = {}
         self.config['Users'] = {}
+        self.config['UserLimits'] = {}
+        self.config['TargetLimits'] = {}
+        self.config['SocketOptions'] = {}
         
         with open(self.config_file, 'w', encoding='utf-8') as f:
             self.config.write(f)
@@ -0,0 +1,105 @@
+import time
+import itertools
+import threading
+from collections import deque
+from threading import Lock, Condition
+
+# 保留的连接事件数量，SSE客户端落后太多时只能拿到最近的事件
+MAX_EVENTS = 1000
+
+
+class ConnectionInfo:
+    """单个隧道的状态
+
+    字段只由所属的转发线程写入，读取方（Web接口）容忍读到稍旧的值，
+    因此更新时不需要加锁。
+    """
+
+    __slots__ = (
+        'id', 'client', 'user', 'target_host', 'target_port', 'proxy',
+        'state', 'start_time', 'bytes_up', 'bytes_down', 'thread_id', 'usage'
+    )
+
+    def __init__(self, conn_id, client, user, target_host, target_port, proxy):
+        self.id = conn_id
+        self.client = client
+        self.user = user
+        self.target_host = target_host
+        self.target_port = target_port
+        self.proxy = proxy
+        self.state = 'connecting'
+        self.start_time = time.time()
+        self.bytes_up = 0
+        self.bytes_down = 0
+        # 登记时所在的处理线程，用于线程栈导出时标注连接
+        self.thread_id = threading.get_ident()
+        # 所用上游IP的使用统计（IPUsage），转发时累加流量供换IP策略判断
+        self.usage = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'client': self.client,
+            'user': self.user,
+            'target': f"{self.target_host}:{self.target_port}",
+            'proxy': self.proxy,
+            'state': self.state,
+            'start_time': int(self.start_time),
+            'duration': int(time.time() - self.start_time),
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down
+        }
+
+
+class ConnectionRegistry:
+    """活动隧道登记表，并为SSE推送记录打开/关闭事件"""
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.event_seq = 0
+        self.ids = itertools.count(1)
+
+    def _add_event(self, event_type, conn):
+        # 事件名不能用 open/close，open 是 EventSource 内置的连接建立事件
+        self.event_seq += 1
+        self.events.append((self.event_seq, event_type, conn.to_dict()))
+        self.changed.notify_all()
+
+    def register(self, client, user, target_host, target_port, proxy):
+        conn = ConnectionInfo(next(self.ids), client, user, target_host, target_port, proxy)
+        with self.lock:
+            self.connections[conn.id] = conn
+            self._add_event('conn_open', conn)
+        return conn
+
+    def unregister(self, conn):
+        with self.lock:
+            if self.connections.pop(conn.id, None) is not None:
+                conn.state = 'closed'
+                self._add_event('conn_close', conn)
+
+    def count(self):
+        return len(self.connections)
+
+    def by_thread(self):
+        """线程ID到连接的映射"""
+        with self.lock:
+            return {c.thread_id: c for c in self.connections.values()}
+
+    def get_page(self, offset=0, limit=50):
+        """按开始时间分页列出活动连接"""
+        with self.lock:
+            conns = list(self.connections.values())
+        conns.sort(key=lambda c: c.id)
+        return len(conns), [c.to_dict() for c in conns[offset:offset + limit]]
+
+    def wait_events(self, last_seq, timeout):
+        """等待 last_seq 之后的新事件，超时返回空列表"""
+        with self.lock:
+            if self.event_seq <= last_seq:
+                self.changed.wait(timeout)
+            events = [e for e in self.events if e[0] > last_seq]
+            return self.event_seq, events
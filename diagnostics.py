@@ -0,0 +1,186 @@
+import sys
+import time
+import threading
+import traceback
+import tracemalloc
+import logging
+from collections import Counter
+
+# 采样间隔（秒）
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# 单次采样最长时间（秒），间隔不小于1毫秒
+MAX_PROFILE_SECONDS = 300
+
+
+def frame_key(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """基于 sys._current_frames 的采样分析器
+
+    只在启动后由一个后台线程周期性采样所有线程的调用栈，停止后不留下任何钩子，
+    未使用时没有开销。
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('SamplingProfiler')
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.start_time = 0
+        self.duration = 0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, interval=DEFAULT_SAMPLE_INTERVAL):
+        """开始采样，已在运行时返回False"""
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.start_time = time.time()
+            self.duration = 0
+            self.stop_event.clear()
+            self.thread = threading.Thread(
+                target=self._run,
+                args=(min(seconds, MAX_PROFILE_SECONDS), max(interval, 0.001)),
+                name='SamplingProfiler',
+                daemon=True
+            )
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stop_event.set()
+        thread = self.thread
+        if thread:
+            thread.join()
+
+    def _run(self, seconds, interval):
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        stacks = self.stacks
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(frame_key(frame))
+                    frame = frame.f_back
+                names.reverse()
+                stacks[';'.join(names)] += 1
+            self.samples += 1
+            self.stop_event.wait(interval)
+        self.duration = time.time() - self.start_time
+        self.logger.info(f"采样结束，共 {self.samples} 次采样")
+
+    def collapsed(self):
+        """火焰图工具使用的折叠栈格式：每行 "栈;帧 次数" """
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def top(self, limit=50):
+        """类似 pstats 的汇总：按函数统计自身和累计采样次数"""
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            names = stack.split(';')
+            self_counts[names[-1]] += count
+            for name in set(names):
+                total_counts[name] += count
+
+        total = sum(self.stacks.values()) or 1
+        lines = [
+            f"{self.samples} samples in {self.duration:.1f}s",
+            '',
+            f"{'self':>8} {'self%':>7} {'cum':>8} {'cum%':>7}  function"
+        ]
+        for name, cum in total_counts.most_common(limit):
+            own = self_counts.get(name, 0)
+            lines.append(
+                f"{own:>8} {own * 100 / total:>6.1f}% {cum:>8} {cum * 100 / total:>6.1f}%  {name}"
+            )
+        return '\n'.join(lines)
+
+
+def dump_threads(registry=None):
+    """导出所有线程的调用栈，并标注线程正在服务的连接"""
+    conns = registry.by_thread() if registry else {}
+    threads = {t.ident: t for t in threading.enumerate()}
+    result = []
+    for ident, frame in sys._current_frames().items():
+        thread = threads.get(ident)
+        conn = conns.get(ident)
+        result.append({
+            'thread_id': ident,
+            'name': thread.name if thread else '',
+            'daemon': thread.daemon if thread else None,
+            'connection': conn.to_dict() if conn else None,
+            'stack': traceback.format_stack(frame)
+        })
+    return result
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+class MemoryTracker:
+    """按需开启的 tracemalloc，每次快照与上一次做差异对比"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_snapshot = None
+
+    @property
+    def running(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.last_snapshot = take_snapshot()
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.last_snapshot = None
+
+    def snapshot(self, limit=30, key_type='lineno'):
+        """返回当前内存占用及与上一次快照相比增长最多的位置"""
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                return None
+            snapshot = take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if self.last_snapshot is not None:
+                stats = snapshot.compare_to(self.last_snapshot, key_type)
+            else:
+                stats = snapshot.statistics(key_type)
+            self.last_snapshot = snapshot
+
+        return {
+            'current': current,
+            'peak': peak,
+            'top': [
+                {
+                    'location': str(stat.traceback[0]),
+                    'size': stat.size,
+                    'size_diff': getattr(stat, 'size_diff', stat.size),
+                    'count': stat.count,
+                    'count_diff': getattr(stat, 'count_diff', stat.count)
+                }
+                for stat in stats[:limit]
+            ]
+        }
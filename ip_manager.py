@@ -1,36 +1,204 @@
-import requests
 import time
 import json
 import logging
-from threading import Lock
+from threading import Lock, Event, Thread
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from providers import ProviderPool
+from proxy_registry import ProxyRegistry
+from rotation_policy import IPUsage, build_policy
+
+# 预轮换失败后的重试间隔（秒）
+PREROTATE_RETRY_DELAY = 2
+# 预轮换线程检查流量、隧道数等策略的间隔（秒）
+POLICY_CHECK_INTERVAL = 1
+# 预轮换线程两次提取之间的最短间隔（秒），防止换IP条件异常时反复提取
+MIN_PREFETCH_INTERVAL = 1
 
 class IPManager:
     def __init__(self, config):
         self.config = config
         self.current_ip = None
+        # 当前IP启用的时间；换IP策略按各IP的 usage 统计判断，interval 同样从启用时开始计算
         self.ip_extract_time = 0
         self.ip_use_count = 0
+        # 预轮换：提前提取并验证好的下一个IP，以及切换后仍可使用的旧IP
+        self.next_ip = None
+        self.previous_ip = None
+        self.previous_until = 0
+        self.prerotate_event = Event()
+        self.prerotate_thread = None
+        self.last_prefetch = 0
+        self.running = False
         self.lock = Lock()
         self.logger = logging.getLogger('IPManager')
+        self.provider_pool = ProviderPool(config)
+        self.proxy_registry = ProxyRegistry(
+            config.validation_ttl, config.reject_ttl, config.registry_size
+        )
+        self.race_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ProviderRace')
+        self.rotation_policy = build_policy(config)
+        
+    def reload_config(self, config):
+        """切换到新的配置快照，保留当前IP和各项统计"""
+        self.config = config
+        self.provider_pool.reload_config(config)
+        self.proxy_registry.configure(config.validation_ttl, config.reject_ttl, config.registry_size)
+        self.rotation_policy = build_policy(config)
+        # 唤醒预轮换线程按新的间隔重新计算
+        self.prerotate_event.set()
+    
+    def start(self):
+        """启动预轮换后台线程"""
+        if self.prerotate_thread:
+            return
+        self.running = True
+        self.prerotate_thread = Thread(target=self.prerotate_loop, name='PreRotate', daemon=True)
+        self.prerotate_thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.prerotate_event.set()
+        self.prerotate_thread = None
+    
+    def need_rotation(self, proxy_info, now):
+        """IP超过存活时间，或 interval 模式下换IP策略条件满足"""
+        if now - proxy_info['extract_time'] > self.config.ip_lifetime:
+            return True
+        usage = proxy_info.get('usage')
+        return bool(usage and self.config.mode == 'interval' and
+                    self.rotation_policy.should_rotate(usage, now))
+    
+    def rotation_due(self, proxy_info, now):
+        """按时间可以预测的换IP时间点，流量等条件触发的换IP由 need_rotation 判断"""
+        due = proxy_info['extract_time'] + self.config.ip_lifetime
+        usage = proxy_info.get('usage')
+        if usage:
+            remaining = self.rotation_policy.remaining_time(usage, now)
+            if remaining is not None:
+                due = min(due, now + remaining)
+        return due
+    
+    def prerotate_loop(self):
+        """在当前IP到期前 prerotate_lead 秒提取并验证下一个IP，到期时直接切换
+        
+        提取和验证都不持有 self.lock，客户端在此期间继续使用当前IP，不会感知到换IP的耗时。
+        """
+        while self.running:
+            self.prerotate_event.clear()
+            lead = self.config.prerotate_lead
+            current_ip = self.current_ip
+            if self.config.mode != 'interval' or not lead or not current_ip:
+                self.prerotate_event.wait(1)
+                continue
+            
+            now = time.time()
+            usage = current_ip['usage']
+            next_ip = self.next_ip
+            if next_ip and now - next_ip['extract_time'] >= self.config.ip_lifetime:
+                self.next_ip = None
+            
+            if self.next_ip is None:
+                # 按时间可预测的提前 lead 秒提取，流量等条件在进度接近时提取
+                lifetime_due = current_ip['extract_time'] + self.config.ip_lifetime
+                if now < lifetime_due - lead and not self.rotation_policy.should_prefetch(usage, now, lead):
+                    delay = self.rotation_due(current_ip, now) - lead - now
+                    self.prerotate_event.wait(min(max(delay, 0.05), POLICY_CHECK_INTERVAL))
+                    continue
+                delay = self.last_prefetch + MIN_PREFETCH_INTERVAL - now
+                if delay > 0:
+                    self.prerotate_event.wait(delay)
+                    continue
+                self.last_prefetch = now
+                if self.config.log_level >= 2:
+                    self.logger.info(f"当前IP即将达到换IP条件，预先提取下一个IP")
+                try:
+                    proxy_info, _ = self.acquire_ip()
+                except Exception as e:
+                    self.logger.warning(f"预轮换提取IP异常: {e}")
+                    proxy_info = None
+                if not proxy_info:
+                    if self.config.log_level >= 1:
+                        self.logger.warning(f"预轮换提取IP失败，{PREROTATE_RETRY_DELAY} 秒后重试")
+                    self.prerotate_event.wait(PREROTATE_RETRY_DELAY)
+                    continue
+                self.next_ip = proxy_info
+                if self.config.log_level >= 1:
+                    self.logger.info(f"下一个IP已就绪: {proxy_info['ip']}:{proxy_info['port']}")
+            
+            # 当前IP可能已被客户端请求提前换掉，重新判断
+            current_ip = self.current_ip
+            now = time.time()
+            if not self.need_rotation(current_ip, now):
+                delay = self.rotation_due(current_ip, now) - now
+                self.prerotate_event.wait(min(max(delay, 0.05), POLICY_CHECK_INTERVAL))
+                continue
+            with self.lock:
+                if self.next_ip and self.current_ip is current_ip:
+                    self.activate_ip(self.next_ip)
+    
+    def activate_ip(self, proxy_info):
+        """切换当前IP，调用方需持有 self.lock
         
-    def extract_ip(self):
-        """从API提取IP"""
+        interval 模式下旧IP在 rotation_overlap 秒内仍可作为连接失败时的备用IP。
+        """
+        now = time.time()
+        old_ip = self.current_ip
+        if old_ip and self.config.mode == 'interval' and self.config.rotation_overlap:
+            self.previous_ip = old_ip
+            self.previous_until = now + self.config.rotation_overlap
+        else:
+            self.previous_ip = None
+        if proxy_info is self.next_ip:
+            self.next_ip = None
+            if self.config.log_level >= 1:
+                old = f"{old_ip['ip']}:{old_ip['port']}" if old_ip else '无'
+                self.logger.info(f"切换到预先验证的IP: {old} -> {proxy_info['ip']}:{proxy_info['port']}")
+        proxy_info['usage'] = IPUsage(self.config.rotation_policy['error_window'])
+        self.current_ip = proxy_info
+        self.ip_extract_time = now
+        self.ip_use_count = 0
+    
+    def get_fallback_ip(self, failed_ip):
+        """切换后的重叠期内，某个IP连接失败时返回另一个可用IP，没有则返回None"""
+        previous_ip = self.previous_ip
+        if not previous_ip or time.time() >= self.previous_until:
+            return None
+        if failed_ip is previous_ip:
+            return self.current_ip
+        if failed_ip is self.current_ip:
+            return previous_ip
+        return None
+    
+    def extract_ip(self, provider):
+        """从指定接口提取IP"""
+        start = time.time()
+        proxy_info = self._extract_ip(provider)
+        if proxy_info:
+            provider.record_extract(True, time.time() - start)
+            proxy_info['provider'] = provider.name
+        else:
+            provider.record_extract(False, time.time() - start, '提取失败')
+        return proxy_info
+    
+    def _extract_ip(self, provider):
+        # requests 连同 urllib3 导入较慢，推迟到第一次提取时，不拖慢启动
+        import requests
         try:
             if self.config.log_level >= 2:
-                self.logger.info(f"开始从API提取IP: {self.config.api_url}")
+                self.logger.info(f"开始从API提取IP [{provider.name}]: {provider.api_url}")
             
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
             
-            response = requests.get(self.config.api_url, headers=headers, timeout=30)
+            response = requests.get(provider.api_url, headers=headers, timeout=30)
             response.raise_for_status()
             
             if self.config.log_level >= 2:
                 self.logger.info(f"API响应状态码: {response.status_code}")
                 self.logger.info(f"API响应内容: '{response.text}'")
             
-            if self.config.api_format == 'json':
+            if provider.api_format == 'json':
                 try:
                     data = response.json()
                     if self.config.log_level >= 2:
@@ -84,13 +252,18 @@ class IPManager:
     
     def check_ip(self, proxy_info):
         """验证IP是否可用"""
+        return self.validate_ip(proxy_info)[0]
+    
+    def validate_ip(self, proxy_info):
+        """验证IP是否可用，返回 (是否可用, 失败原因)"""
+        import requests
         if not proxy_info:
             self.logger.error("proxy_info为空")
-            return False
+            return False, 'empty'
         
         # 如果关闭验证，直接返回成功
         if not self.config.check_proxies:
-            return True
+            return True, ''
             
         try:
             if self.config.log_level >= 2:
@@ -131,26 +304,39 @@ class IPManager:
             
             if response.status_code == 200:
                 # 这里不再记录成功日志，统一在 get_valid_ip 中记录
-                return True
+                return True, ''
             else:
                 self.logger.warning(f"IP验证失败，状态码: {response.status_code}")
-                return False
+                return False, f"status {response.status_code}"
                 
         except requests.exceptions.ConnectTimeout:
             self.logger.warning("连接超时 - 代理可能不可用")
-            return False
+            return False, 'connect timeout'
         except requests.exceptions.ProxyError as e:
             self.logger.warning(f"代理错误: {e}")
-            return False
+            return False, 'proxy error'
         except requests.exceptions.ConnectionError as e:
             self.logger.warning(f"连接错误: {e}")
-            return False
+            return False, 'connection error'
         except Exception as e:
             self.logger.warning(f"IP验证异常: {e}")
-            return False
+            return False, type(e).__name__
     
-    def get_valid_ip(self, force_refresh=False):
-        """获取有效的IP，必要时提取新IP"""
+    def warm_up(self):
+        """启动预热：提前导入 requests，interval 模式下提前准备好第一个IP
+        
+        per_request 模式每个请求都会重新提取，预先提取的IP用不上，返回None。
+        """
+        import requests
+        if self.config.mode != 'interval':
+            return None
+        return self.get_valid_ip(urgent=False)
+    
+    def get_valid_ip(self, force_refresh=False, urgent=True):
+        """获取有效的IP，必要时提取新IP
+
+        urgent 表示有客户端在等待，开启 race_providers 时才会多接口竞速提取。
+        """
         with self.lock:
             now = time.time()
             
@@ -165,9 +351,9 @@ class IPManager:
             if self.config.mode == 'per_request':
                 need_refresh = True
             
-            # 如果是 interval 模式，检查间隔时间
+            # 如果是 interval 模式，按换IP策略（间隔时间、流量、隧道数、错误率等）判断
             elif self.config.mode == 'interval' and self.current_ip:
-                if now - self.current_ip['extract_time'] > self.config.interval:
+                if self.rotation_policy.should_rotate(self.current_ip['usage'], now):
                     need_refresh = True
             
             if not need_refresh and self.current_ip:
@@ -176,6 +362,14 @@ class IPManager:
                 self.ip_use_count += 1
                 return self.current_ip
             
+            # 预轮换已准备好下一个IP时直接切换，无需等待提取
+            next_ip = self.next_ip
+            if (not force_refresh and next_ip and self.config.mode == 'interval' and
+                    now - next_ip['extract_time'] < self.config.ip_lifetime):
+                self.activate_ip(next_ip)
+                self.ip_use_count = 1
+                return self.current_ip
+            
             if self.config.log_level >= 1:
                 self.logger.info(f"需要提取新IP，模式: {self.config.mode}")
             
@@ -185,15 +379,11 @@ class IPManager:
                 if self.config.log_level >= 2:
                     self.logger.info(f"第 {retries + 1} 次尝试提取IP...")
                 
-                proxy_info = self.extract_ip()
+                proxy_info, extracted = self.acquire_ip(urgent)
                 
-                if proxy_info:
-                    if self.config.log_level >= 2:
-                        self.logger.info("成功提取IP，开始验证...")
-                    
-                    if self.check_ip(proxy_info):
-                        self.current_ip = proxy_info
-                        self.ip_extract_time = time.time()
+                if extracted:
+                    if proxy_info:
+                        self.activate_ip(proxy_info)
                         self.ip_use_count = 1
                         # 统一在这里记录验证成功和更新IP的日志
                         if self.config.log_level >= 1:
@@ -218,9 +408,81 @@ class IPManager:
             self.logger.error("无法获取有效IP，已达到最大重试次数")
             return None
     
+    def fetch_and_check(self, provider):
+        """从接口提取并验证IP，返回 (proxy_info, 是否提取成功)"""
+        proxy_info = self.extract_ip(provider)
+        if not proxy_info:
+            return None, False
+        
+        # 最近验证过的IP直接复用结果，避免重复验证或再次接受已知不可用的IP
+        record = self.proxy_registry.lookup(proxy_info)
+        if record is not None:
+            if not record.valid:
+                if self.config.log_level >= 1:
+                    self.logger.warning(f"IP {proxy_info['ip']}:{proxy_info['port']} 近期验证失败({record.reason})，直接丢弃")
+                return None, True
+            if self.config.log_level >= 2:
+                self.logger.info(f"IP {proxy_info['ip']}:{proxy_info['port']} 近期已验证通过，跳过验证")
+            provider.record_valid()
+            return proxy_info, True
+        
+        if self.config.log_level >= 2:
+            self.logger.info("成功提取IP，开始验证...")
+        
+        valid, reason = self.validate_ip(proxy_info)
+        if self.config.check_proxies:
+            self.proxy_registry.record(proxy_info, valid, reason)
+        if not valid:
+            return None, True
+        provider.record_valid()
+        return proxy_info, True
+    
+    def acquire_ip(self, urgent=False):
+        """按权重选择接口获取一个已验证的IP
+
+        开启竞速且 urgent 时同时向两个接口提取；预轮换等后台提取没有客户端等待，只用一个接口，避免多消耗IP。
+        """
+        count = 2 if self.config.race_providers and urgent else 1
+        providers = self.provider_pool.select(count)
+        if not providers:
+            if not self.provider_pool.providers:
+                self.logger.error("未配置IP提取接口")
+                return None, False
+            # 不在这里等待：调用方可能持有 self.lock，由重试循环或预轮换线程稍后再试
+            delay = self.provider_pool.wait_time()
+            if self.config.log_level >= 1:
+                self.logger.warning(f"所有提取接口均已达到速率限制或被停用，{delay:.1f} 秒后才有可用接口")
+            return None, False
+        
+        if len(providers) == 1:
+            return self.fetch_and_check(providers[0])
+        
+        if self.config.log_level >= 2:
+            self.logger.info(f"竞速提取IP: {', '.join(p.name for p in providers)}")
+        
+        # 取最先通过验证的结果，落后的任务在后台自然结束
+        pending = {self.race_executor.submit(self.fetch_and_check, p) for p in providers}
+        extracted = False
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    proxy_info, ok = future.result()
+                except Exception as e:
+                    self.logger.warning(f"竞速提取异常: {e}")
+                    continue
+                extracted = extracted or ok
+                if proxy_info:
+                    return proxy_info, True
+        return None, extracted
+    
     def get_status(self):
-        """获取IP管理器状态"""
-        if not self.current_ip:
+        """获取IP管理器状态
+
+        只读取当前IP的快照引用，不获取 self.lock，避免在刷新IP期间被阻塞。
+        """
+        current_ip = self.current_ip
+        if not current_ip:
             return {
                 'current_ip': None,
                 'ip_age': 0,
@@ -230,12 +492,20 @@ class IPManager:
             }
         
         now = time.time()
-        age = now - self.current_ip['extract_time']
+        age = now - current_ip['extract_time']
+        next_ip = self.next_ip
+        previous_ip = self.previous_ip
+        overlap = self.previous_until - now if previous_ip else 0
         
         return {
-            'current_ip': f"{self.current_ip['ip']}:{self.current_ip['port']}",
+            'current_ip': f"{current_ip['ip']}:{current_ip['port']}",
+            'provider': current_ip.get('provider'),
             'ip_age': int(age),
             'use_count': self.ip_use_count,
             'remaining_time': max(0, self.config.ip_lifetime - int(age)),
-            'status': 'active' if age < self.config.ip_lifetime else 'expired'
+            'status': 'active' if age < self.config.ip_lifetime else 'expired',
+            'next_ip': f"{next_ip['ip']}:{next_ip['port']}" if next_ip else None,
+            'overlap_ip': f"{previous_ip['ip']}:{previous_ip['port']}" if overlap > 0 else None,
+            'overlap_remaining': max(0, int(overlap)),
+            'rotation_policy': self.rotation_policy.get_status(current_ip['usage'], now)
         }
\ No newline at end of file
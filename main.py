@@ -1,17 +1,28 @@
+import time
+# 进程启动时刻，用于启动耗时报告
+START_TIME = time.perf_counter()
+
 import logging
 import signal
+import subprocess
 import sys
-import time
+import threading
 import os
 from config import Config
 from ip_manager import IPManager
-from socks5_server import Socks5Server
-from web_interface import WebInterface
+from socks5_server import Socks5Server, LISTEN_FD_ENV
+# Flask 和 requests 导入较慢，分别在后台线程和第一次提取IP时导入，不拖慢监听端口的绑定
+IMPORT_TIME = time.perf_counter() - START_TIME
+
+# 平滑升级时等待新进程启动的时间（秒），期间新进程退出则放弃升级
+UPGRADE_CHECK_TIME = 2
 
 class ProxyServer:
     def __init__(self):
-        # 删除旧的日志文件
-        self.cleanup_logs()
+        # 删除旧的日志文件，平滑升级启动的新进程沿用旧进程的日志
+        if LISTEN_FD_ENV not in os.environ:
+            self.cleanup_logs()
+        self.upgrading = False
         
         # 加载配置
         self.config = Config()
@@ -22,11 +33,18 @@ class ProxyServer:
         # 初始化组件
         self.ip_manager = IPManager(self.config)
         self.socks5_server = Socks5Server(self.config, self.ip_manager)
-        self.web_interface = WebInterface(self.config, self.ip_manager, self.socks5_server)
+        # Web界面在绑定监听端口之后由后台线程创建
+        self.web_interface = None
+        self.bind_time = 0
         
         # 注册信号处理
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
+        # SIGHUP 重新加载配置，SIGUSR2 平滑升级（Windows 下不可用）
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload_handler)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, self.upgrade_handler)
     
     def cleanup_logs(self):
         """清理旧的日志文件"""
@@ -39,18 +57,18 @@ class ProxyServer:
                 except Exception as e:
                     print(f"删除日志文件失败: {e}")
     
-    def setup_logging(self):
-        """配置日志"""
+    def get_log_level(self, config):
         log_level_map = {
             0: logging.CRITICAL,  # 无日志
             1: logging.INFO,      # 仅显示代理切换和错误信息
             2: logging.DEBUG      # 显示所有详细信息
         }
-        
-        log_level = log_level_map.get(self.config.log_level, logging.INFO)
-        
+        return log_level_map.get(config.log_level, logging.INFO)
+    
+    def setup_logging(self):
+        """配置日志"""
         logging.basicConfig(
-            level=log_level,
+            level=self.get_log_level(self.config),
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
             handlers=[
                 logging.StreamHandler(),
@@ -63,12 +81,119 @@ class ProxyServer:
         self.socks5_server.stop()
         sys.exit(0)
     
+    def reload_handler(self, signum, frame):
+        # 信号处理函数中只启动线程，避免在主线程持有日志锁时重入
+        threading.Thread(target=self.reload_config, daemon=True).start()
+    
+    def upgrade_handler(self, signum, frame):
+        threading.Thread(target=self.upgrade, daemon=True).start()
+    
+    def reload_config(self):
+        """重新读取config.ini，生成新的配置快照并整体替换，不影响已建立的隧道和当前IP"""
+        try:
+            config = Config(self.config.config_file)
+        except Exception as e:
+            logging.error(f"重新加载配置失败，继续使用原配置: {e}")
+            return
+        
+        if config.port != self.config.port or config.web_port != self.config.web_port:
+            logging.warning("端口修改需要重启或平滑升级后生效")
+        
+        self.ip_manager.reload_config(config)
+        self.socks5_server.reload_config(config)
+        if self.web_interface:
+            self.web_interface.reload_config(config)
+        self.config = config
+        logging.getLogger().setLevel(self.get_log_level(config))
+        logging.info("配置已重新加载")
+    
+    def upgrade(self):
+        """平滑升级：启动新进程并把监听socket交给它，本进程停止接受连接后等待隧道结束"""
+        server_socket = self.socks5_server.server_socket
+        if self.upgrading or not server_socket:
+            return
+        self.upgrading = True
+        logging.info("开始平滑升级...")
+        
+        # 先释放Web端口，让新进程可以绑定
+        if self.web_interface:
+            self.web_interface.stop()
+        
+        fd = server_socket.fileno()
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(fd)
+        try:
+            process = subprocess.Popen([sys.executable] + sys.argv, pass_fds=(fd,), env=env)
+            process.wait(timeout=UPGRADE_CHECK_TIME)
+            logging.error(f"新进程启动后退出，退出码: {process.returncode}，取消升级")
+        except subprocess.TimeoutExpired:
+            logging.info(f"新进程已启动 (pid={process.pid})，停止接受新连接")
+            self.ip_manager.stop()
+            self.socks5_server.stop()
+            return
+        except Exception as e:
+            logging.error(f"启动新进程失败，取消升级: {e}")
+        
+        self.upgrading = False
+        if self.web_interface:
+            self.web_interface.start()
+    
+    def start_web_interface(self):
+        """导入Flask并启动Web管理界面"""
+        try:
+            from web_interface import WebInterface
+            web_interface = WebInterface(self.config, self.ip_manager, self.socks5_server)
+        except Exception as e:
+            logging.error(f"Web管理界面初始化失败: {e}")
+            return
+        self.web_interface = web_interface
+        if not self.upgrading:
+            web_interface.start()
+    
+    def warm_up(self):
+        """后台启动Web界面并预先提取首个IP，完成后输出启动耗时报告"""
+        web_thread = threading.Thread(target=self.start_web_interface, name='WebStartup', daemon=True)
+        web_thread.start()
+        
+        try:
+            proxy_info = self.ip_manager.warm_up()
+        except Exception as e:
+            logging.error(f"预先提取IP失败: {e}")
+            proxy_info = None
+        ip_time = time.perf_counter() - START_TIME
+        
+        web_thread.join()
+        web_time = time.perf_counter() - START_TIME
+        web_report = f"{web_time * 1000:.0f}ms" if self.web_interface else '失败'
+        
+        if self.config.mode != 'interval':
+            ip_report = '按需提取'
+        elif proxy_info:
+            ip_report = f"{ip_time * 1000:.0f}ms"
+        else:
+            ip_report = '失败'
+        logging.info(
+            f"启动耗时: 导入 {IMPORT_TIME * 1000:.0f}ms, 绑定端口 {self.bind_time * 1000:.0f}ms, "
+            f"首个可用IP {ip_report}, Web界面 {web_report}"
+        )
+    
     def start(self):
         """启动服务器"""
         logging.info("启动SOCKS5代理服务器...")
         
-        # 启动Web管理界面
-        self.web_interface.start()
+        # 先绑定监听端口，之后到达的连接由内核排队，不会在启动期间被拒绝
+        try:
+            self.socks5_server.bind()
+        except Exception as e:
+            logging.error(f"绑定端口 {self.config.port} 失败: {e}")
+            return
+        self.bind_time = time.perf_counter() - START_TIME
+        
+        # Web管理界面和首个IP在后台准备，不阻塞accept
+        threading.Thread(target=self.warm_up, name='WarmUp', daemon=True).start()
+        
+        # 启动IP预轮换线程
+        self.ip_manager.start()
         
         # 启动SOCKS5服务器
         try:
@@ -78,6 +203,14 @@ class ProxyServer:
         except Exception as e:
             logging.error(f"服务器运行异常: {e}")
             self.socks5_server.stop()
+        
+        # 平滑升级时等待已有连接结束后再退出
+        if self.upgrading:
+            logging.info(f"等待现有连接结束，最长 {self.config.drain_timeout} 秒...")
+            remaining = self.socks5_server.drain(self.config.drain_timeout)
+            if remaining:
+                logging.warning(f"等待超时，强制关闭剩余 {remaining} 个连接")
+            logging.info("旧进程退出")
 
 if __name__ == '__main__':
     server = ProxyServer()
@@ -0,0 +1,129 @@
+import time
+import random
+import logging
+from threading import Lock
+
+# 延迟的指数滑动平均系数
+LATENCY_ALPHA = 0.3
+
+
+class Provider:
+    """单个IP提取接口及其运行统计"""
+
+    def __init__(self, name, api_url, api_format='text', weight=1.0, rate_limit=0, price=0.0):
+        self.name = name
+        self.api_url = api_url
+        self.api_format = api_format
+        self.weight = weight
+        # 每分钟最多提取次数，0 表示不限制
+        self.rate_limit = rate_limit
+        # 每个IP的价格，仅用于统计花费
+        self.price = price
+
+        self.lock = Lock()
+        self.next_allowed = 0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.valid_ips = 0
+        self.avg_latency = 0.0
+        self.cost = 0.0
+        self.last_error = ''
+
+    def reserve(self, now):
+        """占用一次提取名额，受速率限制时返回False"""
+        with self.lock:
+            if now < self.next_allowed:
+                return False
+            if self.rate_limit:
+                self.next_allowed = now + 60.0 / self.rate_limit
+            self.requests += 1
+            return True
+
+    def record_extract(self, success, latency, error=''):
+        with self.lock:
+            if success:
+                self.successes += 1
+                self.cost += self.price
+                if self.avg_latency:
+                    self.avg_latency += LATENCY_ALPHA * (latency - self.avg_latency)
+                else:
+                    self.avg_latency = latency
+            else:
+                self.failures += 1
+                self.last_error = error
+
+    def record_valid(self):
+        with self.lock:
+            self.valid_ips += 1
+
+    def score(self):
+        """选择权重：配置权重 × 平滑成功率 ÷ (1 + 平均延迟)"""
+        success_rate = (self.successes + 1) / (self.requests + 2)
+        return self.weight * success_rate / (1 + self.avg_latency)
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'weight': self.weight,
+                'rate_limit': self.rate_limit,
+                'price': self.price,
+                'requests': self.requests,
+                'successes': self.successes,
+                'failures': self.failures,
+                'valid_ips': self.valid_ips,
+                'avg_latency': round(self.avg_latency, 3),
+                'cost': round(self.cost, 4),
+                'last_error': self.last_error
+            }
+
+
+class ProviderPool:
+    """按权重和观测到的延迟/成功率在多个提取接口间分配请求"""
+
+    def __init__(self, config):
+        self.logger = logging.getLogger('ProviderPool')
+        self.providers = [
+            Provider(name, **options) for name, options in config.providers.items()
+        ]
+
+    def reload_config(self, config):
+        """按新配置重建接口列表，同名接口保留运行统计"""
+        existing = {p.name: p for p in self.providers}
+        providers = []
+        for name, options in config.providers.items():
+            provider = existing.get(name)
+            if provider:
+                with provider.lock:
+                    provider.api_url = options['api_url']
+                    provider.api_format = options.get('api_format', 'text')
+                    provider.weight = options.get('weight', 1.0)
+                    provider.rate_limit = options.get('rate_limit', 0)
+                    provider.price = options.get('price', 0.0)
+            else:
+                provider = Provider(name, **options)
+            providers.append(provider)
+        self.providers = providers
+
+    def select(self, count=1, exclude=()):
+        """加权随机选出最多 count 个当前未被限速的接口（不重复），权重为0的接口视为停用"""
+        candidates = [p for p in self.providers if p not in exclude and p.score() > 0]
+        chosen = []
+        now = time.time()
+        while candidates and len(chosen) < count:
+            scores = [p.score() for p in candidates]
+            provider = random.choices(candidates, weights=scores)[0]
+            candidates.remove(provider)
+            if provider.reserve(now):
+                chosen.append(provider)
+        return chosen
+
+    def wait_time(self):
+        """所有接口都被限速时，距最早可用接口的等待秒数"""
+        providers = [p for p in self.providers if p.weight > 0]
+        if not providers:
+            return 0
+        return max(0, min(p.next_allowed for p in providers) - time.time())
+
+    def get_status(self):
+        return {p.name: p.get_status() for p in self.providers}
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ProxyRecord:
+    """一次验证结果"""
+
+    __slots__ = ('valid', 'checked_at', 'reason')
+
+    def __init__(self, valid, checked_at, reason):
+        self.valid = valid
+        self.checked_at = checked_at
+        self.reason = reason
+
+
+class ProxyRegistry:
+    """最近见过的代理登记表，按 ip:port 缓存验证结果
+
+    验证通过的结果在 good_ttl 秒内可直接复用，验证失败的在 bad_ttl 秒内直接拒绝。
+    容量超过 max_size 时淘汰最久未访问的条目。
+    """
+
+    def __init__(self, good_ttl=60, bad_ttl=600, max_size=1000):
+        self.good_ttl = good_ttl
+        self.bad_ttl = bad_ttl
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.lock = Lock()
+        self.good_hits = 0
+        self.bad_hits = 0
+        self.misses = 0
+
+    def configure(self, good_ttl, bad_ttl, max_size):
+        with self.lock:
+            self.good_ttl = good_ttl
+            self.bad_ttl = bad_ttl
+            self.max_size = max_size
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+
+    @staticmethod
+    def make_key(proxy_info):
+        return f"{proxy_info['ip']}:{proxy_info['port']}"
+
+    def lookup(self, proxy_info):
+        """返回仍在有效期内的验证记录，没有则返回None"""
+        key = self.make_key(proxy_info)
+        now = time.time()
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None:
+                ttl = self.good_ttl if record.valid else self.bad_ttl
+                if now - record.checked_at <= ttl:
+                    self.records.move_to_end(key)
+                    if record.valid:
+                        self.good_hits += 1
+                    else:
+                        self.bad_hits += 1
+                    return record
+                del self.records[key]
+            self.misses += 1
+            return None
+
+    def record(self, proxy_info, valid, reason=''):
+        key = self.make_key(proxy_info)
+        with self.lock:
+            self.records[key] = ProxyRecord(valid, time.time(), reason)
+            self.records.move_to_end(key)
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+
+    def get_status(self):
+        with self.lock:
+            bad = sum(1 for r in self.records.values() if not r.valid)
+            return {
+                'size': len(self.records),
+                'known_bad': bad,
+                'good_hits': self.good_hits,
+                'bad_hits': self.bad_hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,234 @@
+import time
+from collections import deque
+
+# 错误率至少要有这么多次连接结果才参与判断
+ERROR_MIN_SAMPLES = 5
+# 前几次成功连接的平均延迟作为该IP的基准延迟
+LATENCY_BASELINE_SAMPLES = 5
+# 延迟的指数滑动平均系数
+LATENCY_ALPHA = 0.3
+# 流量、隧道数等无法按时间预测的策略进度达到该比例时开始预先提取
+PREFETCH_PROGRESS = 0.8
+
+
+class IPUsage:
+    """单个IP启用以来的使用统计
+
+    由转发线程和连接线程直接累加，不加锁；并发累加在GIL下最多丢失少量计数，
+    对换IP的判断没有影响，换取热路径上的零锁竞争。
+    """
+
+    __slots__ = (
+        'start', 'bytes', 'tunnels', 'results',
+        'latency', 'baseline', 'baseline_samples'
+    )
+
+    def __init__(self, error_window=20):
+        self.start = time.time()
+        self.bytes = 0
+        self.tunnels = 0
+        # 最近 error_window 次连接是否成功；失败次数每次从这里统计，不单独计数以免并发时计数漂移
+        self.results = deque(maxlen=error_window)
+        self.latency = 0.0
+        self.baseline = 0.0
+        self.baseline_samples = 0
+
+    def record_connect(self, ok, latency):
+        self.results.append(ok)
+        if not ok:
+            return
+        self.tunnels += 1
+        if self.baseline_samples < LATENCY_BASELINE_SAMPLES:
+            self.baseline_samples += 1
+            self.baseline += (latency - self.baseline) / self.baseline_samples
+            self.latency = self.baseline
+        else:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+
+    def error_rate(self):
+        results = list(self.results)
+        return results.count(False) / len(results) if results else 0.0
+
+
+class RotationPolicy:
+    """换IP策略基类
+
+    progress 返回 0~1 之间的进度，达到 1 表示应当换IP；remaining_time 返回
+    仅靠时间流逝达到换IP条件还需的秒数，无法预测时返回None，供预轮换提前提取。
+    """
+
+    name = ''
+
+    def progress(self, usage, now):
+        raise NotImplementedError
+
+    def remaining_time(self, usage, now):
+        return None
+
+    def should_rotate(self, usage, now):
+        return self.progress(usage, now) >= 1
+
+    def should_prefetch(self, usage, now, lead):
+        """可按时间预测的策略在到期前 lead 秒，其余策略在进度达到 PREFETCH_PROGRESS 时预先提取"""
+        remaining = self.remaining_time(usage, now)
+        if remaining is not None:
+            return remaining <= lead
+        return self.progress(usage, now) >= PREFETCH_PROGRESS
+
+    def get_status(self, usage, now):
+        return {'name': self.name, 'progress': round(min(self.progress(usage, now), 1), 3)}
+
+
+class TimePolicy(RotationPolicy):
+    """启用超过 seconds 秒后换IP"""
+
+    name = 'time'
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def progress(self, usage, now):
+        return (now - usage.start) / self.seconds
+
+    def remaining_time(self, usage, now):
+        return max(0, usage.start + self.seconds - now)
+
+    def get_status(self, usage, now):
+        status = super().get_status(usage, now)
+        status.update(value=int(now - usage.start), limit=self.seconds)
+        return status
+
+
+class BytesPolicy(RotationPolicy):
+    """经该IP转发的流量超过 limit 字节后换IP"""
+
+    name = 'bytes'
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def progress(self, usage, now):
+        return usage.bytes / self.limit
+
+    def get_status(self, usage, now):
+        status = super().get_status(usage, now)
+        status.update(value=usage.bytes, limit=self.limit)
+        return status
+
+
+class TunnelsPolicy(RotationPolicy):
+    """经该IP建立的隧道数达到 limit 后换IP"""
+
+    name = 'tunnels'
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def progress(self, usage, now):
+        return usage.tunnels / self.limit
+
+    def get_status(self, usage, now):
+        status = super().get_status(usage, now)
+        status.update(value=usage.tunnels, limit=self.limit)
+        return status
+
+
+class ErrorRatePolicy(RotationPolicy):
+    """最近若干次连接的失败比例超过 max_rate 后换IP"""
+
+    name = 'error_rate'
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+
+    def progress(self, usage, now):
+        if len(usage.results) < ERROR_MIN_SAMPLES:
+            return 0
+        return usage.error_rate() / self.max_rate
+
+    def get_status(self, usage, now):
+        status = super().get_status(usage, now)
+        status.update(value=round(usage.error_rate(), 3), limit=self.max_rate)
+        return status
+
+
+class LatencyPolicy(RotationPolicy):
+    """连接延迟的滑动平均超过基准延迟的 factor 倍后换IP"""
+
+    name = 'latency'
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def progress(self, usage, now):
+        if usage.baseline_samples < LATENCY_BASELINE_SAMPLES or not usage.baseline:
+            return 0
+        return usage.latency / (usage.baseline * self.factor)
+
+    def get_status(self, usage, now):
+        status = super().get_status(usage, now)
+        status.update(value=round(usage.latency, 3), baseline=round(usage.baseline, 3), limit=self.factor)
+        return status
+
+
+class CompositePolicy(RotationPolicy):
+    """组合多个策略：any 任一满足即换IP，all 全部满足才换IP"""
+
+    def __init__(self, policies, combine='any'):
+        self.policies = policies
+        self.combine = combine
+        self.name = combine
+
+    def progress(self, usage, now):
+        if not self.policies:
+            return 0
+        values = [p.progress(usage, now) for p in self.policies]
+        return max(values) if self.combine == 'any' else min(values)
+
+    def remaining_time(self, usage, now):
+        times = []
+        for policy in self.policies:
+            remaining = policy.remaining_time(usage, now)
+            if remaining is None:
+                if self.combine == 'any':
+                    continue
+                # all 模式下非时间策略已满足时不影响预测，未满足则无法预测
+                if policy.should_rotate(usage, now):
+                    remaining = 0
+                else:
+                    return None
+            times.append(remaining)
+        if not times:
+            return None
+        return min(times) if self.combine == 'any' else max(times)
+
+    def should_prefetch(self, usage, now, lead):
+        if not self.policies:
+            return False
+        values = [p.should_prefetch(usage, now, lead) for p in self.policies]
+        return any(values) if self.combine == 'any' else all(values)
+
+    def get_status(self, usage, now):
+        return {
+            'combine': self.combine,
+            'progress': round(min(self.progress(usage, now), 1), 3),
+            'rotate': self.should_rotate(usage, now),
+            'policies': [p.get_status(usage, now) for p in self.policies]
+        }
+
+
+def build_policy(config):
+    """根据配置生成换IP策略，interval 模式下 interval 大于0时作为时间策略参与组合"""
+    options = config.rotation_policy
+    policies = []
+    if config.mode == 'interval' and config.interval > 0:
+        policies.append(TimePolicy(config.interval))
+    if options['max_bytes']:
+        policies.append(BytesPolicy(options['max_bytes']))
+    if options['max_tunnels']:
+        policies.append(TunnelsPolicy(options['max_tunnels']))
+    if options['max_error_rate']:
+        policies.append(ErrorRatePolicy(options['max_error_rate']))
+    if options['latency_factor']:
+        policies.append(LatencyPolicy(options['latency_factor']))
+    return CompositePolicy(policies, options['combine'])
@@ -0,0 +1,134 @@
+import os
+import socket
+import select
+import logging
+
+# 布尔类型的选项，其余均为整数
+BOOL_OPTIONS = ('nodelay', 'keepalive', 'fastopen')
+ROLES = ('listener', 'client', 'upstream')
+
+DEFAULT_OPTIONS = {
+    'listener': {'backlog': 100, 'fastopen': False, 'rcvbuf': 0, 'sndbuf': 0},
+    'client': {
+        'nodelay': True, 'keepalive': True, 'keepidle': 60, 'keepintvl': 10, 'keepcnt': 6,
+        'rcvbuf': 0, 'sndbuf': 0
+    },
+    'upstream': {
+        'nodelay': True, 'keepalive': True, 'keepidle': 60, 'keepintvl': 10, 'keepcnt': 6,
+        'rcvbuf': 0, 'sndbuf': 0, 'fastopen': False
+    }
+}
+
+logger = logging.getLogger('SocketOptions')
+
+
+def set_option(sock, level, name, value):
+    """设置socket选项，平台不支持时忽略"""
+    option = getattr(socket, name, None)
+    if option is None:
+        return False
+    try:
+        sock.setsockopt(level, option, value)
+        return True
+    except OSError as e:
+        logger.debug(f"设置 {name}={value} 失败: {e}")
+        return False
+
+
+def wait_connected(sock, timeout):
+    """等待非阻塞connect完成，超时抛出 socket.timeout，连接失败抛出对应的 OSError"""
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        ready = poller.poll(timeout * 1000)
+    else:
+        ready = select.select([], [sock], [], timeout)[1]
+    if not ready:
+        raise socket.timeout('连接超时')
+    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(err, os.strerror(err))
+
+
+class SocketProfile:
+    """一组socket选项，分别用于监听socket、客户端连接和上游连接"""
+
+    def __init__(self, role, options=None):
+        merged = dict(DEFAULT_OPTIONS[role])
+        merged.update(options or {})
+        self.role = role
+        self.backlog = merged.get('backlog', 100)
+        self.nodelay = merged.get('nodelay', False)
+        self.keepalive = merged.get('keepalive', False)
+        self.keepidle = merged.get('keepidle', 0)
+        self.keepintvl = merged.get('keepintvl', 0)
+        self.keepcnt = merged.get('keepcnt', 0)
+        self.rcvbuf = merged.get('rcvbuf', 0)
+        self.sndbuf = merged.get('sndbuf', 0)
+        # 上游连接的 MSG_FASTOPEN 需要内核支持，不可用时自动退回普通connect
+        self.fastopen = merged.get('fastopen', False) and hasattr(socket, 'MSG_FASTOPEN')
+
+    def apply(self, sock):
+        """应用到已创建的socket；缓冲区大小需在connect/listen之前设置才能影响窗口协商"""
+        if self.rcvbuf:
+            set_option(sock, socket.SOL_SOCKET, 'SO_RCVBUF', self.rcvbuf)
+        if self.sndbuf:
+            set_option(sock, socket.SOL_SOCKET, 'SO_SNDBUF', self.sndbuf)
+        if self.role == 'listener':
+            if self.fastopen:
+                set_option(sock, socket.IPPROTO_TCP, 'TCP_FASTOPEN', self.backlog)
+            return
+        if self.nodelay:
+            set_option(sock, socket.IPPROTO_TCP, 'TCP_NODELAY', 1)
+        if self.keepalive:
+            set_option(sock, socket.SOL_SOCKET, 'SO_KEEPALIVE', 1)
+            if self.keepidle:
+                set_option(sock, socket.IPPROTO_TCP, 'TCP_KEEPIDLE', self.keepidle)
+            if self.keepintvl:
+                set_option(sock, socket.IPPROTO_TCP, 'TCP_KEEPINTVL', self.keepintvl)
+            if self.keepcnt:
+                set_option(sock, socket.IPPROTO_TCP, 'TCP_KEEPCNT', self.keepcnt)
+
+    def connect(self, address, first_data=b'', timeout=15):
+        """创建并连接上游socket，开启 fastopen 时 first_data 随SYN一起发送
+
+        返回已连接的socket，first_data 已全部发出。
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.apply(sock)
+            sock.settimeout(timeout)
+            if self.fastopen and first_data:
+                try:
+                    sent = sock.sendto(first_data, socket.MSG_FASTOPEN, address)
+                except BlockingIOError:
+                    # 设置了超时的socket是非阻塞的：还没有TFO cookie时内核只发出SYN（请求cookie），
+                    # 数据未被发送，返回 EINPROGRESS，等待握手完成后再发送
+                    wait_connected(sock, timeout)
+                    sent = 0
+                except (socket.timeout, ConnectionRefusedError):
+                    raise
+                except OSError as e:
+                    # 内核未开启客户端TFO时退回普通连接
+                    logger.debug(f"TCP Fast Open 失败，退回普通连接: {e}")
+                    sock.close()
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.apply(sock)
+                    sock.settimeout(timeout)
+                    sent = None
+                if sent is not None:
+                    if sent < len(first_data):
+                        sock.sendall(first_data[sent:])
+                    return sock
+            sock.connect(address)
+            if first_data:
+                sock.sendall(first_data)
+            return sock
+        except Exception:
+            sock.close()
+            raise
+
+
+def load_profiles(socket_options):
+    """根据配置生成各角色的 SocketProfile"""
+    return {role: SocketProfile(role, socket_options.get(role)) for role in ROLES}
@@ -1,9 +1,137 @@
+import os
+import base64
 import socket
 import select
 import struct
 import logging
-from threading import Thread
+import threading
+from threading import Thread, Lock
 import time
+from traffic_shaper import TrafficShaper, ANONYMOUS_USER
+from connection_registry import ConnectionRegistry
+from socket_options import load_profiles
+
+# 转发缓冲区大小
+BUFFER_SIZE = 8192
+# 缓冲区池最多保留的空闲缓冲区数量
+MAX_FREE_BUFFERS = 256
+# 隧道流量统计提交到用户计数器的间隔（秒）
+STATS_FLUSH_INTERVAL = 1.0
+# 平滑升级时由旧进程传给新进程的监听socket文件描述符
+LISTEN_FD_ENV = 'PROXYYS_LISTEN_FD'
+# accept 超时，用于及时响应停止接受连接的请求
+ACCEPT_TIMEOUT = 1.0
+# 客户端完成握手和发送请求的最长时间，防止不发数据的连接长期占用处理线程
+HANDSHAKE_TIMEOUT = 30
+
+class BufferPool:
+    """转发缓冲区池
+
+    隧道只在一次读写期间借用缓冲区，空闲的隧道不占用缓冲区内存。
+    list 的 pop/append 在GIL下是原子操作，不需要加锁。
+    """
+    
+    def __init__(self, size=BUFFER_SIZE, max_free=MAX_FREE_BUFFERS):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+    
+    def acquire(self):
+        """返回 (bytearray, memoryview)，用完后原样交还"""
+        try:
+            return self.free.pop()
+        except IndexError:
+            buffer = bytearray(self.size)
+            return buffer, memoryview(buffer)
+    
+    def release(self, item):
+        if len(self.free) < self.max_free:
+            self.free.append(item)
+
+class SocketReader:
+    """带缓冲的socket读取器
+
+    每个阶段只消费自己需要的字节，客户端把问候、认证、CONNECT甚至首批数据
+    合并在一个包里发送（pipelining）时，多读到的字节留在缓冲区给后续阶段。
+    """
+    
+    __slots__ = ('sock', 'buffer')
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+    
+    def read_exact(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('连接在握手阶段被关闭')
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+    
+    def read_until(self, delimiter, max_size):
+        """读到 delimiter 为止（包含），超过 max_size 仍未出现时抛出异常"""
+        while True:
+            index = self.buffer.find(delimiter)
+            if index >= 0:
+                return self.read_exact(index + len(delimiter))
+            if len(self.buffer) >= max_size:
+                raise ValueError('响应头过长')
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('连接在握手阶段被关闭')
+            self.buffer += chunk
+    
+    def take_remaining(self):
+        """取出握手后缓冲区中剩余的数据（客户端提前发送的负载）"""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+class SocketWaiter:
+    """等待隧道两端的socket可读
+
+    优先使用 poll，不受 select 的 FD_SETSIZE(1024) 限制，
+    否则大量并发连接时文件描述符超过1024的隧道会直接失败；不支持 poll 的平台退回 select。
+    """
+    
+    __slots__ = ('poller', 'by_fd', 'masks')
+    
+    def __init__(self, sockets):
+        self.poller = select.poll() if hasattr(select, 'poll') else None
+        if self.poller is None:
+            return
+        self.by_fd = {}
+        self.masks = {}
+        for sock in sockets:
+            fd = sock.fileno()
+            self.by_fd[fd] = sock
+            self.masks[fd] = select.POLLIN
+            self.poller.register(fd, select.POLLIN)
+    
+    def wait(self, read_sockets, sockets, timeout):
+        """返回 (可读socket列表, 是否出错)"""
+        if self.poller is None:
+            readable, _, exceptional = select.select(read_sockets, [], sockets, timeout)
+            return readable, bool(exceptional)
+        
+        # 只在暂停/恢复读取时修改注册的事件
+        for fd, sock in self.by_fd.items():
+            mask = select.POLLIN if sock in read_sockets else 0
+            if self.masks[fd] != mask:
+                self.poller.modify(fd, mask)
+                self.masks[fd] = mask
+        
+        readable = []
+        error = False
+        for fd, event in self.poller.poll(timeout * 1000):
+            if event & (select.POLLERR | select.POLLNVAL):
+                error = True
+            elif event & (select.POLLIN | select.POLLHUP):
+                readable.append(self.by_fd[fd])
+        return readable, error
 
 class Socks5Server:
     def __init__(self, config, ip_manager):
@@ -12,15 +140,77 @@ class Socks5Server:
         self.logger = logging.getLogger('Socks5Server')
         self.running = False
         self.server_socket = None
+        self.traffic_shaper = TrafficShaper(config)
+        self.connections = ConnectionRegistry()
+        self.socket_profiles = load_profiles(config.socket_options)
+        self.buffer_pool = BufferPool()
+        self.active_clients = 0
+        self.clients_lock = Lock()
+        self.handler_stack_size = self.load_stack_size(config)
+    
+    def reload_config(self, config):
+        """切换到新的配置快照，已建立的隧道继续使用原有限速桶"""
+        self.config = config
+        self.traffic_shaper.reload_config(config)
+        self.socket_profiles = load_profiles(config.socket_options)
+        self.handler_stack_size = self.load_stack_size(config)
+    
+    def load_stack_size(self, config):
+        """校验处理线程栈大小配置（字节），无效时返回0使用系统默认值"""
+        size = config.thread_stack_size * 1024
+        if not size:
+            return 0
+        try:
+            threading.stack_size(threading.stack_size(size))
+        except (ValueError, RuntimeError) as e:
+            self.logger.warning(f"线程栈大小 {config.thread_stack_size}KB 无效，使用系统默认值: {e}")
+            return 0
+        return size
+    
+    def start_handler(self, thread):
+        """按配置的栈大小启动处理线程
+
+        threading.stack_size 是进程级设置，只在创建处理线程时临时修改并立即恢复，
+        避免影响多接口竞速、Web接口等其他线程。
+        """
+        size = self.handler_stack_size
+        if not size:
+            thread.start()
+            return
+        previous = threading.stack_size(size)
+        try:
+            thread.start()
+        finally:
+            threading.stack_size(previous)
+    
+    def create_server_socket(self):
+        """创建监听socket，平滑升级时直接接管旧进程传来的socket"""
+        inherited_fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if inherited_fd:
+            server_socket = socket.socket(fileno=int(inherited_fd))
+            if self.config.log_level >= 1:
+                self.logger.info(f"接管旧进程的监听socket (fd={inherited_fd})")
+            return server_socket
         
+        profile = self.socket_profiles['listener']
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # 缓冲区大小在listen前设置，accept得到的连接会继承
+        profile.apply(server_socket)
+        server_socket.bind(('0.0.0.0', self.config.port))
+        server_socket.listen(profile.backlog)
+        return server_socket
+    
+    def bind(self):
+        """创建并绑定监听socket，之后到达的连接由内核排队，等待 start 开始accept"""
+        if not self.server_socket:
+            self.server_socket = self.create_server_socket()
+            self.server_socket.settimeout(ACCEPT_TIMEOUT)
+    
     def start(self):
         """启动SOCKS5服务器"""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
         try:
-            self.server_socket.bind(('0.0.0.0', self.config.port))
-            self.server_socket.listen(100)
+            self.bind()
             self.running = True
             
             if self.config.log_level >= 1:
@@ -33,6 +223,8 @@ class Socks5Server:
             while self.running:
                 try:
                     client_socket, client_address = self.server_socket.accept()
+                    client_socket.settimeout(HANDSHAKE_TIMEOUT)
+                    self.socket_profiles['client'].apply(client_socket)
                     
                     if self.config.log_level >= 2:
                         self.logger.info(f"新的连接来自: {client_address[0]}:{client_address[1]}")
@@ -43,8 +235,10 @@ class Socks5Server:
                         args=(client_socket, client_address)
                     )
                     client_thread.daemon = True
-                    client_thread.start()
+                    self.start_handler(client_thread)
                     
+                except socket.timeout:
+                    continue
                 except Exception as e:
                     if self.running:
                         self.logger.error(f"接受连接时出错: {e}")
@@ -59,48 +253,97 @@ class Socks5Server:
         self.running = False
         if self.server_socket:
             self.server_socket.close()
+            self.server_socket = None
         
         if self.config.log_level >= 1:
             self.logger.info("SOCKS5代理服务器已停止")
     
+    def drain(self, timeout):
+        """等待正在处理的客户端结束，最多等待 timeout 秒，返回剩余的客户端数"""
+        deadline = time.time() + timeout
+        while self.active_clients and time.time() < deadline:
+            time.sleep(0.5)
+        return self.active_clients
+    
     def handle_client(self, client_socket, client_address):
         """处理客户端连接"""
+        with self.clients_lock:
+            self.active_clients += 1
         try:
+            reader = SocketReader(client_socket)
+            
             # SOCKS5握手
-            if not self.socks5_handshake(client_socket, client_address):
+            username = self.socks5_handshake(reader, client_address)
+            if not username:
                 return
             
             # 获取客户端请求
-            target_host, target_port = self.get_client_request(client_socket)
+            target_host, target_port = self.get_client_request(reader)
             if not target_host:
                 return
+            # 握手完成后转发阶段不设超时，由 SocketWaiter 等待数据
+            client_socket.settimeout(None)
             
             if self.config.log_level >= 1:
                 self.logger.info(f"客户端 {client_address[0]} 请求连接: {target_host}:{target_port}")
             
-            # 获取有效的代理IP - 在 per_request 模式下强制刷新
-            force_refresh = (self.config.mode == 'per_request')
-            
-            if self.config.log_level >= 2:
-                self.logger.info(f"获取有效代理IP, 强制刷新: {force_refresh}")
-            
-            proxy_info = self.ip_manager.get_valid_ip(force_refresh=force_refresh)
-            if not proxy_info:
-                client_socket.close()
-                self.logger.error("无法获取有效代理IP，连接终止")
+            # 检查用户并发隧道配额
+            if not self.traffic_shaper.acquire_tunnel(username):
+                self.logger.warning(f"用户 {username} 并发隧道数已达上限，拒绝连接")
+                self.send_error_response(client_socket, 2)
                 return
             
-            # 通过上游代理连接目标
-            remote_socket = self.connect_via_proxy(proxy_info, target_host, target_port)
-            if not remote_socket:
-                client_socket.close()
-                return
-            
-            # 发送成功响应
-            self.send_success_response(client_socket, target_host, target_port)
-            
-            # 开始数据转发
-            self.forward_data(client_socket, remote_socket)
+            conn = None
+            try:
+                # 获取有效的代理IP - 在 per_request 模式下强制刷新
+                force_refresh = (self.config.mode == 'per_request')
+                
+                if self.config.log_level >= 2:
+                    self.logger.info(f"获取有效代理IP, 强制刷新: {force_refresh}")
+                
+                proxy_info = self.ip_manager.get_valid_ip(force_refresh=force_refresh)
+                if not proxy_info:
+                    client_socket.close()
+                    self.logger.error("无法获取有效代理IP，连接终止")
+                    return
+                
+                conn = self.connections.register(
+                    f"{client_address[0]}:{client_address[1]}", username,
+                    target_host, target_port, f"{proxy_info['ip']}:{proxy_info['port']}"
+                )
+                
+                # 通过上游代理连接目标
+                usage = proxy_info.get('usage')
+                remote_socket, remote_pending, reachable = self.connect_with_stats(proxy_info, target_host, target_port)
+                if not remote_socket:
+                    # 刚换IP的重叠期内改用另一个IP重试一次
+                    fallback_ip = self.ip_manager.get_fallback_ip(proxy_info)
+                    if fallback_ip:
+                        if self.config.log_level >= 1:
+                            self.logger.info(f"改用重叠期内的IP {fallback_ip['ip']}:{fallback_ip['port']} 重试")
+                        usage = fallback_ip.get('usage')
+                        conn.proxy = f"{fallback_ip['ip']}:{fallback_ip['port']}"
+                        remote_socket, remote_pending, reachable = self.connect_with_stats(fallback_ip, target_host, target_port)
+                if not remote_socket and reachable:
+                    # 上游可以连通但SOCKS5和HTTP协议都失败时，尝试直接连接（绕过代理）
+                    remote_socket = self.connect_direct(target_host, target_port)
+                    usage = None
+                    conn.proxy = 'direct'
+                if not remote_socket:
+                    client_socket.close()
+                    return
+                
+                # 发送成功响应
+                self.send_success_response(client_socket, target_host, target_port)
+                
+                # 开始数据转发，客户端随CONNECT提前发送的数据一并转发给上游
+                conn.state = 'established'
+                conn.usage = usage
+                self.forward_data(client_socket, remote_socket, conn, reader.take_remaining(), remote_pending)
+            finally:
+                if conn:
+                    self.connections.unregister(conn)
+                self.traffic_shaper.release_tunnel(username)
             
         except Exception as e:
             self.logger.error(f"处理客户端时出错: {e}")
@@ -109,25 +352,24 @@ class Socks5Server:
                 client_socket.close()
             except:
                 pass
+            with self.clients_lock:
+                self.active_clients -= 1
     
-    def socks5_handshake(self, client_socket, client_address):
-        """SOCKS5握手，包含用户认证"""
+    def socks5_handshake(self, reader, client_address):
+        """SOCKS5握手，包含用户认证，成功时返回用户名，失败返回None"""
+        client_socket = reader.sock
         try:
             # 读取客户端认证方法
-            data = client_socket.recv(1024)
+            version, nmethods = reader.read_exact(2)
+            # 先检查版本，非SOCKS5客户端（如HTTP请求）不再继续等待方法列表
+            if version != 5 or not nmethods:
+                if self.config.log_level >= 2:
+                    self.logger.debug(f"非SOCKS5握手数据: {bytes([version, nmethods]).hex()}")
+                return None
+            methods = reader.read_exact(nmethods)
             
             if self.config.log_level >= 2:
-                self.logger.debug(f"收到握手数据: {data.hex()}")
-            
-            if len(data) < 3:
-                return False
-            
-            version, nmethods = struct.unpack('!BB', data[:2])
-            if version != 5:
-                return False
-            
-            # 检查是否需要用户认证
-            methods = data[2:2 + nmethods]
+                self.logger.debug(f"收到握手数据: {bytes([version, nmethods]).hex()}{methods.hex()}")
             
             # 如果有配置用户，要求用户名密码认证
             if self.config.users:
@@ -136,17 +378,13 @@ class Socks5Server:
                     client_socket.send(struct.pack('!BB', 5, 2))
                     
                     # 读取认证信息
-                    auth_data = client_socket.recv(512)
-                    if len(auth_data) < 3:
-                        return False
-                    
-                    auth_version, username_len = struct.unpack('!BB', auth_data[:2])
+                    auth_version, username_len = reader.read_exact(2)
                     if auth_version != 1:
-                        return False
+                        return None
                     
-                    username = auth_data[2:2+username_len].decode('utf-8')
-                    password_len = auth_data[2+username_len]
-                    password = auth_data[3+username_len:3+username_len+password_len].decode('utf-8')
+                    username = reader.read_exact(username_len).decode('utf-8')
+                    password_len = reader.read_exact(1)[0]
+                    password = reader.read_exact(password_len).decode('utf-8')
                     
                     # 验证用户名和密码
                     if username in self.config.users and self.config.users[username] == password:
@@ -154,17 +392,17 @@ class Socks5Server:
                         client_socket.send(struct.pack('!BB', 1, 0))
                         if self.config.log_level >= 1:
                             self.logger.info(f"用户 {username} 认证成功，来自 {client_address[0]}")
-                        return True
+                        return username
                     else:
                         # 认证失败
                         client_socket.send(struct.pack('!BB', 1, 1))
                         if self.config.log_level >= 1:
                             self.logger.warning(f"用户认证失败，用户名: {username}，来自 {client_address[0]}")
-                        return False
+                        return None
                 else:
                     # 客户端不支持用户名密码认证
                     client_socket.send(struct.pack('!BB', 5, 0xFF))
-                    return False
+                    return None
             else:
                 # 没有配置用户，使用无认证
                 if 0 in methods:  # NO AUTHENTICATION REQUIRED
@@ -173,42 +411,43 @@ class Socks5Server:
                     if self.config.log_level >= 2:
                         self.logger.debug("发送无认证响应")
                     
-                    return True
+                    return ANONYMOUS_USER
                 else:
                     # 不支持其他认证方法
                     client_socket.send(struct.pack('!BB', 5, 0xFF))
-                    return False
+                    return None
                 
         except Exception as e:
             self.logger.error(f"握手失败: {e}")
-            return False
+            return None
     
-    def get_client_request(self, client_socket):
+    def get_client_request(self, reader):
         """获取客户端请求的目标地址"""
         try:
-            data = client_socket.recv(1024)
-            
-            if self.config.log_level >= 2:
-                self.logger.debug(f"收到请求数据: {data.hex()}")
-            
-            if len(data) < 7:
-                return None, None
-            
-            version, cmd, rsv, atyp = struct.unpack('!BBBB', data[:4])
-            if version != 5 or cmd != 1:  # 只支持CONNECT命令
+            version, cmd, rsv, atyp = reader.read_exact(4)
+            if version != 5:
                 return None, None
             
             if atyp == 1:  # IPv4
-                target_host = socket.inet_ntoa(data[4:8])
-                target_port = struct.unpack('!H', data[8:10])[0]
+                target_host = socket.inet_ntoa(reader.read_exact(4))
             elif atyp == 3:  # 域名
-                host_length = data[4]
-                target_host = data[5:5 + host_length].decode('utf-8')
-                target_port = struct.unpack('!H', data[5 + host_length:7 + host_length])[0]
+                host_length = reader.read_exact(1)[0]
+                target_host = reader.read_exact(host_length).decode('utf-8')
             elif atyp == 4:  # IPv6
-                # 简化处理，不支持IPv6
+                # 读完整个请求，但不支持IPv6
+                reader.read_exact(18)
+                self.send_error_response(reader.sock, 8)
                 return None, None
             else:
+                self.send_error_response(reader.sock, 8)
+                return None, None
+            target_port = struct.unpack('!H', reader.read_exact(2))[0]
+            
+            if self.config.log_level >= 2:
+                self.logger.debug(f"收到请求: cmd={cmd}, atyp={atyp}, 目标={target_host}:{target_port}")
+            
+            if cmd != 1:  # 只支持CONNECT命令
+                self.send_error_response(reader.sock, 7)
                 return None, None
             
             return target_host, target_port
@@ -217,102 +456,196 @@ class Socks5Server:
             self.logger.error(f"解析客户端请求失败: {e}")
             return None, None
     
+    def connect_with_stats(self, proxy_info, target_host, target_port):
+        """连接上游并把结果和耗时计入该IP的使用统计，供换IP策略判断"""
+        start = time.monotonic()
+        result = self.connect_via_proxy(proxy_info, target_host, target_port)
+        usage = proxy_info.get('usage')
+        if usage:
+            usage.record_connect(result[0] is not None, time.monotonic() - start)
+        return result
+    
     def connect_via_proxy(self, proxy_info, target_host, target_port):
-        """通过上游代理连接目标"""
+        """通过上游代理连接目标，返回 (socket, 上游已发来的数据, 上游是否可连通)
+
+        返回的socket一定经由上游代理；失败时socket为None，上游可连通但协议失败时第三项为True。
+        """
         try:
             if self.config.log_level >= 2:
                 self.logger.info(f"连接到上游代理 {proxy_info['ip']}:{proxy_info['port']}")
             
-            # 创建到上游代理的socket
-            proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            proxy_socket.settimeout(15)
-            proxy_socket.connect((proxy_info['ip'], proxy_info['port']))
+            upstream_profile = self.socket_profiles['upstream']
+            proxy_address = (proxy_info['ip'], proxy_info['port'])
+            messages = self.build_socks5_messages(proxy_info, target_host, target_port)
+            
+            # 已知上游认证方式时，问候、认证和CONNECT合并为一次发送；
+            # 开启 fastopen 时首次发送的数据随SYN一起发出
+            pipeline = (
+                self.config.upstream_pipelining
+                and proxy_info.get('socks_method') is not None
+                and proxy_info.get('socks_pipelining', True)
+            )
+            proxy_socket = upstream_profile.connect(
+                proxy_address, self.socks5_first_write(messages, proxy_info, pipeline)
+            )
             
             if self.config.log_level >= 2:
                 self.logger.info("成功连接到上游代理")
             
             # 尝试SOCKS5协议
             try:
-                # SOCKS5握手
-                handshake = struct.pack('!BBB', 5, 1, 0)
-                proxy_socket.send(handshake)
-                response = proxy_socket.recv(10)
-                
-                if self.config.log_level >= 2:
-                    self.logger.debug(f"SOCKS5握手响应: {response.hex()}")
-                
-                if len(response) >= 2:
-                    ver, method = struct.unpack('!BB', response[:2])
-                    if ver == 5:
-                        # 发送连接请求
-                        request = struct.pack('!BBBB', 5, 1, 0, 3)
-                        request += struct.pack('!B', len(target_host)) + target_host.encode('utf-8')
-                        request += struct.pack('!H', target_port)
-                        proxy_socket.send(request)
-                        
-                        response = proxy_socket.recv(1024)
-                        if self.config.log_level >= 2:
-                            self.logger.debug(f"SOCKS5连接响应: {response.hex()}")
-                        
-                        if len(response) >= 2:
-                            ver, status = struct.unpack('!BB', response[:2])
-                            if status == 0:
-                                if self.config.log_level >= 1:
-                                    self.logger.info("SOCKS5代理连接成功")
-                                return proxy_socket
-                            elif status == 84:
-                                # 特殊处理84错误码 - 尝试忽略错误继续使用连接
-                                self.logger.warning(f"上游代理返回84错误码，尝试继续使用连接")
-                                return proxy_socket
-                            else:
-                                self.logger.error(f"SOCKS5代理连接失败，状态码: {status}")
+                pending = self.negotiate_socks5(proxy_socket, proxy_info, messages, pipeline)
+                if pending is not None:
+                    return proxy_socket, pending, True
             except Exception as e:
                 self.logger.warning(f"SOCKS5协议失败: {e}")
+                if pipeline:
+                    # 上游不接受合并发送，之后对该IP改为逐步协商，并立即重试一次
+                    proxy_info['socks_pipelining'] = False
+                    proxy_socket.close()
+                    proxy_socket = upstream_profile.connect(proxy_address, messages[0])
+                    try:
+                        pending = self.negotiate_socks5(proxy_socket, proxy_info, messages, False)
+                        if pending is not None:
+                            return proxy_socket, pending, True
+                    except Exception as e:
+                        self.logger.warning(f"SOCKS5协议失败: {e}")
             
             # 如果SOCKS5失败，尝试HTTP代理协议
             try:
-                # 重新连接
+                # 重新连接并发送HTTP CONNECT请求
                 proxy_socket.close()
-                proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                proxy_socket.settimeout(15)
-                proxy_socket.connect((proxy_info['ip'], proxy_info['port']))
-                
-                # 发送HTTP CONNECT请求
-                connect_request = f"CONNECT {target_host}:{target_port} HTTP/1.1\r\nHost: {target_host}:{target_port}\r\n\r\n"
-                proxy_socket.send(connect_request.encode())
+                connect_request = f"CONNECT {target_host}:{target_port} HTTP/1.1\r\nHost: {target_host}:{target_port}\r\n"
+                if proxy_info.get('username') and proxy_info.get('password'):
+                    credentials = base64.b64encode(
+                        f"{proxy_info['username']}:{proxy_info['password']}".encode('utf-8')
+                    ).decode('ascii')
+                    connect_request += f"Proxy-Authorization: Basic {credentials}\r\n"
+                connect_request += "\r\n"
+                proxy_socket = upstream_profile.connect(proxy_address, connect_request.encode())
                 
-                response = proxy_socket.recv(1024)
+                # 只读到响应头结束，之后的数据属于隧道
+                reader = SocketReader(proxy_socket)
+                response = reader.read_until(b"\r\n\r\n", 8192)
                 if self.config.log_level >= 2:
                     self.logger.debug(f"HTTP代理响应: {response}")
                 
-                if b"200 Connection established" in response:
+                status_line = response.split(b"\r\n", 1)[0].split()
+                if len(status_line) >= 2 and status_line[1] == b"200":
                     if self.config.log_level >= 1:
                         self.logger.info("HTTP代理连接成功")
-                    return proxy_socket
+                    return proxy_socket, reader.take_remaining(), True
                 else:
                     self.logger.warning("HTTP代理连接失败")
             except Exception as e:
                 self.logger.warning(f"HTTP代理协议失败: {e}")
             
-            # 如果都失败，尝试直接连接（绕过代理）
-            try:
-                proxy_socket.close()
-                remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remote_socket.settimeout(15)
-                remote_socket.connect((target_host, target_port))
-                if self.config.log_level >= 1:
-                    self.logger.info("直接连接成功（绕过代理）")
-                return remote_socket
-            except Exception as e:
-                self.logger.error(f"直接连接也失败: {e}")
-            
-            return None
+            proxy_socket.close()
+            return None, b'', True
             
         except socket.timeout:
             self.logger.error("连接上游代理超时")
-            return None
+            return None, b'', False
         except Exception as e:
             self.logger.error(f"通过代理连接目标失败: {e}")
+            return None, b'', False
+    
+    def connect_direct(self, target_host, target_port):
+        """不经代理直接连接目标，失败返回None"""
+        try:
+            remote_socket = self.socket_profiles['upstream'].connect((target_host, target_port))
+            if self.config.log_level >= 1:
+                self.logger.info("直接连接成功（绕过代理）")
+            return remote_socket
+        except Exception as e:
+            self.logger.error(f"直接连接也失败: {e}")
+            return None
+    
+    def build_socks5_messages(self, proxy_info, target_host, target_port):
+        """生成发往上游的 (问候, 认证, CONNECT请求)，没有账号时认证为空"""
+        username = proxy_info.get('username', '')
+        password = proxy_info.get('password', '')
+        if username and password:
+            username = username.encode('utf-8')
+            password = password.encode('utf-8')
+            greeting = struct.pack('!BBBB', 5, 2, 0, 2)  # 无认证 + 用户名密码认证
+            auth = struct.pack('!BB', 1, len(username)) + username
+            auth += struct.pack('!B', len(password)) + password
+        else:
+            greeting = struct.pack('!BBB', 5, 1, 0)
+            auth = b''
+        
+        host = target_host.encode('utf-8')
+        request = struct.pack('!BBBBB', 5, 1, 0, 3, len(host)) + host
+        request += struct.pack('!H', target_port)
+        return greeting, auth, request
+    
+    def socks5_first_write(self, messages, proxy_info, pipeline):
+        greeting, auth, request = messages
+        if not pipeline:
+            return greeting
+        if proxy_info.get('socks_method') == 2:
+            return greeting + auth + request
+        return greeting + request
+    
+    def negotiate_socks5(self, proxy_socket, proxy_info, messages, pipeline):
+        """完成与上游的SOCKS5协商
+
+        成功时返回应答之后上游已发来的数据，上游拒绝时返回None，协议错误时抛出异常。
+        pipeline 为True表示问候之后的消息已随问候一起发出，这里只依次校验应答。
+        """
+        greeting, auth, request = messages
+        reader = SocketReader(proxy_socket)
+        
+        ver, method = reader.read_exact(2)
+        if self.config.log_level >= 2:
+            self.logger.debug(f"SOCKS5握手响应: ver={ver}, method={method}")
+        
+        if ver != 5:
+            raise ConnectionError(f"上游不是SOCKS5代理 (ver={ver})")
+        if method not in (0, 2) or (method == 2 and not auth):
+            self.logger.error(f"上游SOCKS5代理不接受提供的认证方式 (method={method})")
+            return None
+        if pipeline and method != proxy_info.get('socks_method'):
+            raise ConnectionError("上游认证方式已变化，合并发送的数据无效")
+        proxy_info['socks_method'] = method
+        
+        if method == 2:
+            if not pipeline:
+                proxy_socket.sendall(auth)
+            _, auth_status = reader.read_exact(2)
+            if auth_status != 0:
+                self.logger.error(f"上游SOCKS5代理认证失败，状态码: {auth_status}")
+                return None
+        
+        if not pipeline:
+            proxy_socket.sendall(request)
+        
+        ver, status, _, atyp = reader.read_exact(4)
+        # 读完整个变长的绑定地址，避免应答字节混入隧道
+        if atyp == 1:
+            reader.read_exact(4)
+        elif atyp == 3:
+            reader.read_exact(reader.read_exact(1)[0])
+        elif atyp == 4:
+            reader.read_exact(16)
+        else:
+            raise ConnectionError(f"SOCKS5连接响应地址类型无效: {atyp}")
+        reader.read_exact(2)
+        
+        if self.config.log_level >= 2:
+            self.logger.debug(f"SOCKS5连接响应: ver={ver}, status={status}, atyp={atyp}")
+        
+        if status == 0:
+            if self.config.log_level >= 1:
+                self.logger.info("SOCKS5代理连接成功")
+            return reader.take_remaining()
+        elif status == 84:
+            # 特殊处理84错误码 - 尝试忽略错误继续使用连接
+            self.logger.warning(f"上游代理返回84错误码，尝试继续使用连接")
+            return reader.take_remaining()
+        else:
+            self.logger.error(f"SOCKS5代理连接失败，状态码: {status}")
             return None
     
     def send_success_response(self, client_socket, target_host, target_port):
@@ -328,16 +661,84 @@ class Socks5Server:
         except Exception as e:
             self.logger.error(f"发送响应失败: {e}")
     
-    def forward_data(self, client_socket, remote_socket):
-        """转发客户端和远程服务器之间的数据"""
+    def send_error_response(self, client_socket, code):
+        """发送失败响应给客户端"""
+        try:
+            response = struct.pack('!BBBB', 5, code, 0, 1)
+            response += socket.inet_aton('0.0.0.0')
+            response += struct.pack('!H', 0)
+            client_socket.send(response)
+        except Exception as e:
+            if self.config.log_level >= 2:
+                self.logger.error(f"发送失败响应出错: {e}")
+    
+    def forward_data(self, client_socket, remote_socket, conn=None, pending=b'', pending_down=b''):
+        """转发客户端和远程服务器之间的数据
+
+        pending 为握手阶段已读到的客户端数据，pending_down 为上游在连接应答之后已发来的数据。
+        """
+        username = conn.user if conn else ANONYMOUS_USER
+        target_host = conn.target_host if conn else ''
+        usage = conn.usage if conn else None
+        up_buckets, down_buckets = self.traffic_shaper.get_buckets(username, target_host)
+        buffer_pool = self.buffer_pool
+        bytes_up = 0
+        bytes_down = 0
+        last_flush = time.monotonic()
         sockets = [client_socket, remote_socket]
+        waiter = SocketWaiter(sockets)
+        client_only = [client_socket]
+        remote_only = [remote_socket]
+        no_sockets = []
         
         try:
             if self.config.log_level >= 2:
                 self.logger.info("开始数据转发")
             
-            while True:
-                readable, _, exceptional = select.select(sockets, [], sockets, 60)
+            if pending:
+                if self.config.log_level >= 2:
+                    self.logger.debug(f"转发握手阶段收到的 {len(pending)} 字节客户端数据")
+                remote_socket.sendall(pending)
+                bytes_up += len(pending)
+                now = time.monotonic()
+                for bucket in up_buckets:
+                    bucket.consume(len(pending), now)
+            
+            if pending_down:
+                client_socket.sendall(pending_down)
+                bytes_down += len(pending_down)
+                now = time.monotonic()
+                for bucket in down_buckets:
+                    bucket.consume(len(pending_down), now)
+            
+            closed = False
+            while not closed:
+                now = time.monotonic()
+                
+                # 有未提交的统计时缩短超时，保证空闲后也能及时提交
+                timeout = STATS_FLUSH_INTERVAL if (bytes_up or bytes_down) else 60
+                
+                # 令牌不足的方向暂停读取，等待时间作为select超时
+                up_delay = 0
+                for bucket in up_buckets:
+                    up_delay = max(up_delay, bucket.delay(now))
+                down_delay = 0
+                for bucket in down_buckets:
+                    down_delay = max(down_delay, bucket.delay(now))
+                
+                if up_delay and down_delay:
+                    read_sockets = no_sockets
+                    timeout = min(timeout, up_delay, down_delay)
+                elif up_delay:
+                    read_sockets = remote_only
+                    timeout = min(timeout, up_delay)
+                elif down_delay:
+                    read_sockets = client_only
+                    timeout = min(timeout, down_delay)
+                else:
+                    read_sockets = sockets
+                
+                readable, exceptional = waiter.wait(read_sockets, sockets, timeout)
                 
                 if exceptional:
                     if self.config.log_level >= 2:
@@ -345,30 +746,60 @@ class Socks5Server:
                     break
                 
                 for sock in readable:
+                    item = buffer_pool.acquire()
+                    buffer, view = item
                     try:
-                        data = sock.recv(8192)
-                        if not data:
+                        n = sock.recv_into(buffer)
+                        if not n:
                             if self.config.log_level >= 2:
                                 self.logger.info("连接被对方关闭")
+                            closed = True
                             break
                         
+                        now = time.monotonic()
                         if sock is client_socket:
                             if self.config.log_level >= 2:
-                                self.logger.debug(f"从客户端收到 {len(data)} 字节数据")
-                            remote_socket.send(data)
+                                self.logger.debug(f"从客户端收到 {n} 字节数据")
+                            remote_socket.sendall(view[:n])
+                            bytes_up += n
+                            for bucket in up_buckets:
+                                bucket.consume(n, now)
                         else:
                             if self.config.log_level >= 2:
-                                self.logger.debug(f"从远程收到 {len(data)} 字节数据")
-                            client_socket.send(data)
+                                self.logger.debug(f"从远程收到 {n} 字节数据")
+                            client_socket.sendall(view[:n])
+                            bytes_down += n
+                            for bucket in down_buckets:
+                                bucket.consume(n, now)
                     except Exception as e:
                         if self.config.log_level >= 2:
                             self.logger.error(f"数据转发出错: {e}")
+                        closed = True
                         break
+                    finally:
+                        buffer_pool.release(item)
+                
+                now = time.monotonic()
+                if now - last_flush >= STATS_FLUSH_INTERVAL:
+                    self.traffic_shaper.add_bytes(username, bytes_up, bytes_down)
+                    if conn:
+                        conn.bytes_up += bytes_up
+                        conn.bytes_down += bytes_down
+                    if usage:
+                        usage.bytes += bytes_up + bytes_down
+                    bytes_up = bytes_down = 0
+                    last_flush = now
                 
         except Exception as e:
             if self.config.log_level >= 2:
                 self.logger.error(f"数据转发异常: {e}")
         finally:
+            self.traffic_shaper.add_bytes(username, bytes_up, bytes_down)
+            if conn:
+                conn.bytes_up += bytes_up
+                conn.bytes_down += bytes_down
+            if usage:
+                usage.bytes += bytes_up + bytes_down
             try:
                 client_socket.close()
             except:
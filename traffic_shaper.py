@@ -0,0 +1,191 @@
+import time
+import logging
+from threading import Lock
+
+ANONYMOUS_USER = 'anonymous'
+DEFAULT_LIMIT_KEY = '*'
+
+
+class TokenBucket:
+    """令牌桶限速器
+
+    允许透支：consume 直接扣减令牌，令牌为负时由 delay 给出需要等待的时间，
+    转发循环据此暂停读取对应方向的socket。多个隧道线程共享同一个桶时不加锁，
+    并发扣减在GIL下最多丢失少量扣减，只会造成轻微超发，换取零锁竞争。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst else max(rate, 65536))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def set_rate(self, rate, burst=None):
+        """原地修改速率，保留已有令牌，共享该桶的隧道立即按新速率限速"""
+        self.rate = float(rate)
+        self.capacity = float(burst if burst else max(rate, 65536))
+        if self.tokens > self.capacity:
+            self.tokens = self.capacity
+    
+    def consume(self, amount, now):
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.capacity:
+            tokens = self.capacity
+        self.tokens = tokens - amount
+        self.last = now
+
+    def delay(self, now):
+        """返回令牌恢复为非负所需的秒数，0 表示可以立即读取"""
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens >= 0:
+            return 0
+        return -tokens / self.rate
+
+
+class UserStats:
+    """单个用户的流量统计"""
+
+    def __init__(self):
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.active_tunnels = 0
+        self.total_tunnels = 0
+        self.rejected_tunnels = 0
+
+
+class TrafficShaper:
+    """按用户/目标的带宽整形、并发隧道配额和流量统计"""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = Lock()
+        self.logger = logging.getLogger('TrafficShaper')
+        self.user_buckets = {}
+        self.target_buckets = {}
+        self.stats = {}
+
+    def reload_config(self, config):
+        """切换配置并按新限速更新缓存的限速桶
+
+        限速仍存在的桶原地修改速率，新旧隧道继续共享同一个桶，重新加载不会让用户获得额外带宽；
+        限速被取消的桶从缓存中移除，新增的限速只对之后建立的隧道生效。
+        """
+        with self.lock:
+            self.config = config
+            user_buckets = {}
+            for username, buckets in self.user_buckets.items():
+                up, down, _ = self.get_user_limit(username)
+                user_buckets[username] = (
+                    self._update_bucket(buckets[0], up),
+                    self._update_bucket(buckets[1], down)
+                )
+            self.user_buckets = user_buckets
+            
+            target_buckets = {}
+            for target_host, buckets in self.target_buckets.items():
+                limit = config.target_limits.get(target_host)
+                if limit:
+                    target_buckets[target_host] = (
+                        self._update_bucket(buckets[0], limit[0]),
+                        self._update_bucket(buckets[1], limit[1])
+                    )
+            self.target_buckets = target_buckets
+    
+    @staticmethod
+    def _update_bucket(bucket, rate):
+        if not rate:
+            return None
+        if bucket is None:
+            return TokenBucket(rate)
+        if bucket.rate != rate:
+            bucket.set_rate(rate)
+        return bucket
+
+    def get_user_limit(self, username):
+        limits = self.config.user_limits
+        return limits.get(username) or limits.get(DEFAULT_LIMIT_KEY) or (0, 0, 0)
+
+    def _user_buckets(self, username):
+        buckets = self.user_buckets.get(username)
+        if buckets is None:
+            up, down, _ = self.get_user_limit(username)
+            buckets = (
+                TokenBucket(up) if up else None,
+                TokenBucket(down) if down else None
+            )
+            self.user_buckets[username] = buckets
+        return buckets
+
+    def _target_buckets(self, target_host):
+        # 主机名不区分大小写，限速和缓存都用小写作键，避免改变大小写绕过限速
+        target_host = target_host.lower()
+        limit = self.config.target_limits.get(target_host)
+        if not limit:
+            return None, None
+        buckets = self.target_buckets.get(target_host)
+        if buckets is None:
+            up, down = limit
+            buckets = (
+                TokenBucket(up) if up else None,
+                TokenBucket(down) if down else None
+            )
+            self.target_buckets[target_host] = buckets
+        return buckets
+
+    def acquire_tunnel(self, username):
+        """占用一个并发隧道名额，超出配额时返回False"""
+        max_tunnels = self.get_user_limit(username)[2]
+        with self.lock:
+            stats = self.stats.get(username)
+            if stats is None:
+                stats = self.stats[username] = UserStats()
+            if max_tunnels and stats.active_tunnels >= max_tunnels:
+                stats.rejected_tunnels += 1
+                return False
+            stats.active_tunnels += 1
+            stats.total_tunnels += 1
+            return True
+
+    def release_tunnel(self, username):
+        with self.lock:
+            stats = self.stats.get(username)
+            if stats and stats.active_tunnels > 0:
+                stats.active_tunnels -= 1
+
+    def get_buckets(self, username, target_host):
+        """返回 (上传桶元组, 下载桶元组)，未配置限速的方向为空元组"""
+        with self.lock:
+            user_up, user_down = self._user_buckets(username)
+            target_up, target_down = self._target_buckets(target_host)
+        up = tuple(b for b in (user_up, target_up) if b)
+        down = tuple(b for b in (user_down, target_down) if b)
+        return up, down
+
+    def add_bytes(self, username, bytes_up, bytes_down):
+        """累加隧道流量，由转发循环批量提交以避免逐块加锁"""
+        if not bytes_up and not bytes_down:
+            return
+        with self.lock:
+            stats = self.stats.get(username)
+            if stats is None:
+                stats = self.stats[username] = UserStats()
+            stats.bytes_up += bytes_up
+            stats.bytes_down += bytes_down
+
+    def get_status(self):
+        """获取各用户流量和限速状态"""
+        with self.lock:
+            result = {}
+            for username, stats in self.stats.items():
+                up, down, max_tunnels = self.get_user_limit(username)
+                result[username] = {
+                    'bytes_up': stats.bytes_up,
+                    'bytes_down': stats.bytes_down,
+                    'active_tunnels': stats.active_tunnels,
+                    'total_tunnels': stats.total_tunnels,
+                    'rejected_tunnels': stats.rejected_tunnels,
+                    'limit_up': up,
+                    'limit_down': down,
+                    'max_tunnels': max_tunnels
+                }
+            return result
@@ -1,6 +1,13 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response
+from werkzeug.serving import make_server
 import threading
 import logging
+import json
+import time
+from diagnostics import SamplingProfiler, MemoryTracker, dump_threads, DEFAULT_SAMPLE_INTERVAL
+
+# SSE 推送状态的间隔（秒）
+EVENT_INTERVAL = 1
 
 class WebInterface:
     def __init__(self, config, ip_manager, socks5_server):
@@ -9,7 +16,11 @@ class WebInterface:
         self.socks5_server = socks5_server
         self.app = Flask(__name__)
         self.logger = logging.getLogger('WebInterface')
+        self.server = None
+        self.profiler = SamplingProfiler()
+        self.memory_tracker = MemoryTracker()
         self.setup_routes()
+        self.setup_admin_routes()
     
     def setup_routes(self):
         @self.app.route('/')
@@ -25,6 +36,7 @@ class WebInterface:
                     .box { background: #f0f0f0; padding: 20px; margin: 10px 0; border-radius: 5px; }
                     button { background: #007cba; color: white; padding: 10px 15px; border: none; border-radius: 3px; cursor: pointer; margin: 5px; }
                     input { padding: 8px; margin: 5px; width: 250px; }
+                    td, th { padding: 2px 10px; text-align: left; }
                     .message { padding: 10px; margin: 10px 0; border-radius: 3px; }
                     .success { background: #d4edda; color: #155724; }
                     .error { background: #f8d7da; color: #721c24; }
@@ -44,6 +56,11 @@ class WebInterface:
                     <div id="status">请先保存Token</div>
                 </div>
                 
+                <div class="box">
+                    <h3>🔗 活动连接</h3>
+                    <table id="connections"></table>
+                </div>
+                
                 <button onclick="refreshIP()" id="refreshBtn">🔄 强制刷新IP</button>
                 <button onclick="refreshStatus()">🔄 刷新状态</button>
                 
@@ -51,6 +68,8 @@ class WebInterface:
                 
                 <script>
                     let token = '';
+                    let eventSource = null;
+                    const connections = {};
                     
                     function saveToken() {
                         const input = document.getElementById('tokenInput').value;
@@ -62,11 +81,12 @@ class WebInterface:
                         localStorage.setItem('proxyToken', token);
                         showMessage('Token已保存', 'success');
                         refreshStatus();
+                        subscribeEvents();
                     }
                     
                     function showMessage(msg, type) {
                         const div = document.getElementById('message');
-                        div.innerHTML = '<div class="message ' + type + '">' + msg + '</div>';
+                        div.innerHTML = '<div class="message ' + type + '">' + escapeHtml(msg) + '</div>';
                         setTimeout(() => div.innerHTML = '', 3000);
                     }
                     
@@ -83,16 +103,120 @@ class WebInterface:
                                     showMessage('错误: ' + data.error, 'error');
                                     return;
                                 }
-                                document.getElementById('status').innerHTML = 
-                                    '运行: ' + (data.running ? '✅' : '❌') + '<br>' +
-                                    'IP: ' + (data.current_ip || '无') + '<br>' +
-                                    '年龄: ' + (data.ip_age || 0) + '秒<br>' +
-                                    '使用: ' + (data.use_count || 0) + '次<br>' +
-                                    '剩余: ' + (data.remaining_time || 0) + '秒';
+                                renderStatus(data);
                             })
                             .catch(err => showMessage('获取状态失败: ' + err, 'error'));
                     }
                     
+                    // 目标主机、用户名等来自客户端请求或外部接口，插入HTML前必须转义
+                    function escapeHtml(value) {
+                        return String(value).replace(/[&<>"']/g, ch => ({
+                            '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+                        })[ch]);
+                    }
+                    
+                    function renderStatus(data) {
+                        document.getElementById('status').innerHTML = 
+                            '运行: ' + (data.running ? '✅' : '❌') + '<br>' +
+                            'IP: ' + escapeHtml(data.current_ip || '无') + (data.provider ? ' (' + escapeHtml(data.provider) + ')' : '') + '<br>' +
+                            '年龄: ' + (data.ip_age || 0) + '秒<br>' +
+                            '使用: ' + (data.use_count || 0) + '次<br>' +
+                            '剩余: ' + (data.remaining_time || 0) + '秒<br>' +
+                            (data.next_ip ? '下一个IP: ' + escapeHtml(data.next_ip) + '<br>' : '') +
+                            (data.overlap_ip ? '备用旧IP: ' + escapeHtml(data.overlap_ip) + ' (' + data.overlap_remaining + '秒)<br>' : '') +
+                            '活动连接: ' + (data.connections || 0) +
+                            formatPolicy(data.rotation_policy) +
+                            formatProviders(data.providers || {}) +
+                            formatUsers(data.users || {});
+                    }
+                    
+                    function renderConnections() {
+                        let html = '<tr><th>客户端</th><th>用户</th><th>目标</th><th>上游代理</th><th>时长</th><th>流量</th></tr>';
+                        const now = Date.now() / 1000;
+                        for (const id in connections) {
+                            const c = connections[id];
+                            html += '<tr><td>' + escapeHtml(c.client) + '</td><td>' + escapeHtml(c.user) +
+                                '</td><td>' + escapeHtml(c.target) + '</td><td>' + escapeHtml(c.proxy) +
+                                '</td><td>' + Math.max(0, Math.round(now - c.start_time)) +
+                                '秒</td><td>↑' + formatBytes(c.bytes_up) + ' ↓' + formatBytes(c.bytes_down) + '</td></tr>';
+                        }
+                        document.getElementById('connections').innerHTML = html;
+                    }
+                    
+                    function loadConnections() {
+                        fetch('/connections?per_page=500&token=' + encodeURIComponent(token))
+                            .then(r => r.json())
+                            .then(data => {
+                                if (data.error) return;
+                                for (const id in connections) delete connections[id];
+                                data.connections.forEach(c => connections[c.id] = c);
+                                renderConnections();
+                            });
+                    }
+                    
+                    function subscribeEvents() {
+                        if (!window.EventSource) return false;
+                        if (eventSource) eventSource.close();
+                        eventSource = new EventSource('/events?token=' + encodeURIComponent(token));
+                        // 建立或重连SSE时整体加载一次连接列表，之后由 conn_open/conn_close 增量更新
+                        eventSource.onopen = loadConnections;
+                        eventSource.addEventListener('status', e => renderStatus(JSON.parse(e.data)));
+                        eventSource.addEventListener('conn_open', e => {
+                            const c = JSON.parse(e.data);
+                            connections[c.id] = c;
+                            renderConnections();
+                        });
+                        eventSource.addEventListener('conn_close', e => {
+                            delete connections[JSON.parse(e.data).id];
+                            renderConnections();
+                        });
+                        return true;
+                    }
+                    
+                    function formatBytes(n) {
+                        if (n >= 1073741824) return (n / 1073741824).toFixed(2) + 'GB';
+                        if (n >= 1048576) return (n / 1048576).toFixed(2) + 'MB';
+                        if (n >= 1024) return (n / 1024).toFixed(1) + 'KB';
+                        return n + 'B';
+                    }
+                    
+                    function formatPolicy(policy) {
+                        if (!policy || !policy.policies.length) return '';
+                        let html = '<br>🔄 换IP策略(' + escapeHtml(policy.combine) + '): ' + Math.round(policy.progress * 100) + '%';
+                        for (const p of policy.policies) {
+                            html += ' ' + escapeHtml(p.name) + ' ' + Math.round(p.progress * 100) + '%';
+                        }
+                        return html;
+                    }
+                    
+                    function formatProviders(providers) {
+                        let html = '';
+                        for (const name in providers) {
+                            const p = providers[name];
+                            html += '<br>🌐 ' + escapeHtml(name) +
+                                ' 权重: ' + p.weight +
+                                ' 成功: ' + p.successes + '/' + p.requests +
+                                ' 有效IP: ' + p.valid_ips +
+                                ' 延迟: ' + p.avg_latency + '秒' +
+                                (p.price ? ' 花费: ' + p.cost : '');
+                        }
+                        return html;
+                    }
+                    
+                    function formatUsers(users) {
+                        let html = '';
+                        for (const name in users) {
+                            const u = users[name];
+                            html += '<br>👤 ' + escapeHtml(name) +
+                                ' ↑' + formatBytes(u.bytes_up) +
+                                ' ↓' + formatBytes(u.bytes_down) +
+                                ' 隧道: ' + u.active_tunnels + (u.max_tunnels ? '/' + u.max_tunnels : '') +
+                                (u.limit_up ? ' 上传限速: ' + formatBytes(u.limit_up) + '/s' : '') +
+                                (u.limit_down ? ' 下载限速: ' + formatBytes(u.limit_down) + '/s' : '');
+                        }
+                        return html;
+                    }
+                    
                     function refreshIP() {
                         if (!token) {
                             showMessage('请先保存Token', 'error');
@@ -128,7 +252,10 @@ class WebInterface:
                             document.getElementById('tokenInput').value = saved;
                             refreshStatus();
                         }
-                        setInterval(refreshStatus, 5000);
+                        // 优先使用SSE推送，不支持时退回轮询
+                        if (!(token && subscribeEvents())) {
+                            setInterval(() => { if (token && !eventSource) refreshStatus(); }, 5000);
+                        }
                     }
                 </script>
             </body>
@@ -141,15 +268,40 @@ class WebInterface:
             if self.config.token and token != self.config.token:
                 return jsonify({'error': '未授权'}), 401
             
-            ip_status = self.ip_manager.get_status()
+            return jsonify(self.get_status())
+        
+        @self.app.route('/connections')
+        def connections():
+            token = request.args.get('token')
+            if self.config.token and token != self.config.token:
+                return jsonify({'error': '未授权'}), 401
+            
+            try:
+                page = max(1, int(request.args.get('page', 1)))
+                per_page = min(500, max(1, int(request.args.get('per_page', 50))))
+            except ValueError:
+                return jsonify({'error': '分页参数无效'}), 400
+            
+            total, items = self.socks5_server.connections.get_page((page - 1) * per_page, per_page)
             return jsonify({
-                'running': self.socks5_server.running,
-                'current_ip': ip_status.get('current_ip'),
-                'ip_age': ip_status.get('ip_age', 0),
-                'use_count': ip_status.get('use_count', 0),
-                'remaining_time': ip_status.get('remaining_time', 0)
+                'total': total,
+                'page': page,
+                'per_page': per_page,
+                'connections': items
             })
         
+        @self.app.route('/events')
+        def events():
+            token = request.args.get('token')
+            if self.config.token and token != self.config.token:
+                return jsonify({'error': '未授权'}), 401
+            
+            return Response(
+                self.event_stream(),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+        
         @self.app.route('/refresh_ip', methods=['POST'])
         def refresh_ip():
             token = request.args.get('token')
@@ -177,17 +329,172 @@ class WebInterface:
                     'message': f'IP刷新失败：{str(e)}'
                 })
     
+    def check_admin_token(self):
+        """诊断接口必须配置token才能使用"""
+        token = request.args.get('token')
+        return bool(self.config.token) and token == self.config.token
+    
+    def setup_admin_routes(self):
+        @self.app.route('/admin/profile/start', methods=['POST'])
+        def profile_start():
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            try:
+                seconds = float(request.args.get('seconds', 30))
+                interval = float(request.args.get('interval', DEFAULT_SAMPLE_INTERVAL))
+            except ValueError:
+                return jsonify({'error': '参数无效'}), 400
+            
+            if not self.profiler.start(seconds, interval):
+                return jsonify({'error': '采样已在运行'}), 409
+            self.logger.info(f"开始采样分析，时长 {seconds} 秒")
+            return jsonify({'success': True, 'seconds': seconds})
+        
+        @self.app.route('/admin/profile/stop', methods=['POST'])
+        def profile_stop():
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            self.profiler.stop()
+            return self.profile_result()
+        
+        @self.app.route('/admin/profile')
+        def profile():
+            """运行中返回状态；传入 seconds 时同步采样并直接返回结果"""
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            seconds = request.args.get('seconds')
+            if seconds:
+                try:
+                    seconds = float(seconds)
+                except ValueError:
+                    return jsonify({'error': '参数无效'}), 400
+                if not self.profiler.start(seconds):
+                    return jsonify({'error': '采样已在运行'}), 409
+                self.profiler.thread.join()
+            elif self.profiler.running:
+                return jsonify({
+                    'running': True,
+                    'samples': self.profiler.samples,
+                    'elapsed': int(time.time() - self.profiler.start_time)
+                })
+            return self.profile_result()
+        
+        @self.app.route('/admin/threads')
+        def threads():
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            return jsonify(dump_threads(self.socks5_server.connections))
+        
+        @self.app.route('/admin/memory/start', methods=['POST'])
+        def memory_start():
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            try:
+                frames = int(request.args.get('frames', 1))
+            except ValueError:
+                return jsonify({'error': '参数无效'}), 400
+            self.memory_tracker.start(frames)
+            self.logger.info("已开启内存分配跟踪")
+            return jsonify({'success': True})
+        
+        @self.app.route('/admin/memory/stop', methods=['POST'])
+        def memory_stop():
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            self.memory_tracker.stop()
+            self.logger.info("已关闭内存分配跟踪")
+            return jsonify({'success': True})
+        
+        @self.app.route('/admin/memory')
+        def memory():
+            if not self.check_admin_token():
+                return jsonify({'error': '未授权'}), 401
+            
+            try:
+                limit = int(request.args.get('limit', 30))
+            except ValueError:
+                return jsonify({'error': '参数无效'}), 400
+            key_type = request.args.get('group', 'lineno')
+            if key_type not in ('lineno', 'filename', 'traceback'):
+                return jsonify({'error': '参数无效'}), 400
+            
+            result = self.memory_tracker.snapshot(limit, key_type)
+            if result is None:
+                return jsonify({'error': '内存跟踪未开启，请先调用 /admin/memory/start'}), 409
+            return jsonify(result)
+    
+    def profile_result(self):
+        """按 format 参数返回折叠栈（collapsed）或函数汇总（top）"""
+        if request.args.get('format', 'collapsed') == 'top':
+            text = self.profiler.top()
+        else:
+            text = self.profiler.collapsed()
+        return Response(text, mimetype='text/plain')
+    
+    def get_status(self):
+        """汇总服务器状态，供 /status 和 /events 共用"""
+        ip_status = self.ip_manager.get_status()
+        return {
+            'running': self.socks5_server.running,
+            'current_ip': ip_status.get('current_ip'),
+            'ip_age': ip_status.get('ip_age', 0),
+            'use_count': ip_status.get('use_count', 0),
+            'remaining_time': ip_status.get('remaining_time', 0),
+            'provider': ip_status.get('provider'),
+            'next_ip': ip_status.get('next_ip'),
+            'overlap_ip': ip_status.get('overlap_ip'),
+            'overlap_remaining': ip_status.get('overlap_remaining', 0),
+            'rotation_policy': ip_status.get('rotation_policy'),
+            'providers': self.ip_manager.provider_pool.get_status(),
+            'proxy_registry': self.ip_manager.proxy_registry.get_status(),
+            'users': self.socks5_server.traffic_shaper.get_status(),
+            'connections': self.socks5_server.connections.count()
+        }
+    
+    def event_stream(self):
+        """SSE事件流：连接打开/关闭时立即推送，状态每秒推送一次"""
+        registry = self.socks5_server.connections
+        last_seq = registry.event_seq
+        yield f"event: status\ndata: {json.dumps(self.get_status())}\n\n"
+        last_status = time.monotonic()
+        
+        while True:
+            last_seq, new_events = registry.wait_events(last_seq, EVENT_INTERVAL)
+            for _, event_type, data in new_events:
+                yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+            
+            now = time.monotonic()
+            if now - last_status >= EVENT_INTERVAL:
+                yield f"event: status\ndata: {json.dumps(self.get_status())}\n\n"
+                last_status = now
+    
+    def reload_config(self, config):
+        self.config = config
+    
+    def run_server(self):
+        try:
+            self.server = make_server('0.0.0.0', self.config.web_port, self.app, threaded=True)
+        except Exception as e:
+            self.logger.error(f"Web管理界面启动失败: {e}")
+            return
+        self.server.serve_forever()
+    
     def start(self):
         """启动Web界面"""
-        threading.Thread(
-            target=lambda: self.app.run(
-                host='0.0.0.0', 
-                port=self.config.web_port, 
-                debug=False,
-                use_reloader=False
-            ),
-            daemon=True
-        ).start()
+        threading.Thread(target=self.run_server, daemon=True).start()
         
         if self.config.log_level >= 1:
-            self.logger.info(f"Web管理界面启动在端口 {self.config.web_port}")
\ No newline at end of file
+            self.logger.info(f"Web管理界面启动在端口 {self.config.web_port}")
+    
+    def stop(self):
+        """停止Web界面并释放端口，供平滑升级时新进程绑定"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
\ No newline at end of file